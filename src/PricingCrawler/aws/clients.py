@@ -0,0 +1,31 @@
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import boto3
+
+# ウォームスタートのLambdaでは、前回までの呼び出しで作成したクライアントを使い回す
+# （boto3のクライアントはスレッドセーフ。Lambdaの実行ロールの認証情報の更新もboto3が行う）
+_clients: Dict[Tuple[str, Optional[str]], Any] = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name: str, region_name: Optional[str] = None) -> Any:
+    """
+    boto3.client(service_name, region_name=region_name)と同じ。作成済みのクライアントがあればそれを返す
+    """
+    key: Tuple[str, Optional[str]] = (service_name, region_name)
+    with _lock:
+        # boto3の既定のセッションでのクライアントの作成はスレッドセーフではないため、ロック内で作る
+        client: Any = _clients.get(key)
+        if client is None:
+            client = boto3.client(service_name, region_name=region_name)
+            _clients[key] = client
+        return client
+
+
+def invalidate_clients() -> None:
+    """
+    キャッシュしたクライアントを破棄する（次のget_clientで作り直す）
+    """
+    with _lock:
+        _clients.clear()
@@ -1,5 +1,41 @@
-from typing import Any
-import boto3
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Union
+from botocore.exceptions import BotoCoreError, ClientError
+
+from .clients import get_client
+
+# S3のマルチパートアップロードでは、最後以外のパートは5MB以上である必要がある
+MIN_PART_SIZE: int = 5 * 1024 * 1024  # 5 MB
+DEFAULT_PART_SIZE: int = 64 * 1024 * 1024  # 64 MB
+PART_UPLOAD_ATTEMPTS: int = 3  # 1パートあたりのアップロードの試行回数
+PART_UPLOAD_BASE_DELAY_S: float = 1.0
+# 圧縮形式ごとのファイルの拡張子（例: printpac-sticker_2024-07-31-05-54-53.json.zst）
+COMPRESSION_EXTENSIONS: Dict[str, str] = {"gzip": ".gz", "zstd": ".zst"}
+GZIP_LEVEL: int = 6
+ZSTD_LEVEL: int = 3
+
+
+def _new_compressor(compression: str) -> Any:
+    """
+    compress()/flush()で使えるストリーミング圧縮器を返す
+    flush()で1つのgzipメンバー/zstdフレームが完結し、連結したものも1つの圧縮ファイルとして読めます
+    """
+    if compression == "gzip":
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == "zstd":
+        import zstandard  # zstdを使う場合だけ読み込む
+
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Unsupported compression [{compression}]")
+
+
+class MultipartUploadAborted(Exception):
+    """
+    パートのアップロードが再試行しても失敗したため、マルチパートアップロードを中止した
+    """
 
 
 class S3_Client:
@@ -8,7 +44,7 @@ class S3_Client:
     subdir: str
 
     def __init__(self, s3_bucketname, s3_subdir) -> None:
-        self.s3 = boto3.client("s3")
+        self.s3 = get_client("s3")
         self.bucket_name = s3_bucketname
         self.subdir = s3_subdir
 
@@ -32,6 +68,28 @@ class S3_Client:
             Body=buffer,
         )
 
+    def upload_part_with_retry(
+        self,
+        file_name: str,
+        part_number: int,
+        upload_id: str,
+        buffer,
+        max_attempts: int = PART_UPLOAD_ATTEMPTS,
+    ):
+        """
+        一時的なエラーで失敗したパートを指数バックオフで再試行する
+        """
+        attempt: int = 1
+        while True:
+            try:
+                return self.upload_part(file_name, part_number, upload_id, buffer)
+            except (BotoCoreError, ClientError) as e:
+                if attempt >= max_attempts:
+                    raise e
+                print(f"Retrying upload of part [{part_number}] of [{file_name}]: {e}")
+                time.sleep(PART_UPLOAD_BASE_DELAY_S * (2 ** (attempt - 1)))
+                attempt += 1
+
     def complete_multipart_upload(self, file_name: str, upload_id: str, parts):
         return self.s3.complete_multipart_upload(
             Bucket=self.bucket_name,
@@ -39,3 +97,287 @@ class S3_Client:
             UploadId=upload_id,
             MultipartUpload={"Parts": parts},
         )
+
+    def put_object(self, file_name: str, body):
+        return self.s3.put_object(
+            Bucket=self.bucket_name,
+            Key=self.subdir + file_name,
+            Body=body,
+        )
+
+    def put_object_if_absent(self, file_name: str, body) -> bool:
+        """
+        同じキーのオブジェクトがない場合だけ作成する（条件付き書き込み: If-None-Match）
+        戻り値: 作成した場合True、既にあった（または同時に作成された）場合False
+        """
+        return self._put_object_conditionally(file_name, body, IfNoneMatch="*")
+
+    def put_object_if_match(self, file_name: str, body, etag: str) -> bool:
+        """
+        同じキーのオブジェクトのETagがetagの場合だけ上書きする（条件付き書き込み: If-Match）
+        戻り値: 上書きした場合True、既に他の書き込みで変わっていた（または削除された）場合False
+        """
+        return self._put_object_conditionally(file_name, body, IfMatch=etag)
+
+    def _put_object_conditionally(self, file_name: str, body, **condition) -> bool:
+        try:
+            self.s3.put_object(
+                Bucket=self.bucket_name,
+                Key=self.subdir + file_name,
+                Body=body,
+                **condition,
+            )
+            return True
+        except ClientError as e:
+            # 409: 同じキーへの条件付き書き込みが同時に行われた
+            # 404: If-Matchで上書きするオブジェクトが削除された
+            if e.response["Error"]["Code"] in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+                "NoSuchKey",
+            ):
+                return False
+            raise e
+
+    def get_object(self, file_name: str):
+        return self.s3.get_object(Bucket=self.bucket_name, Key=self.subdir + file_name)
+
+    def delete_object(self, file_name: str):
+        return self.s3.delete_object(
+            Bucket=self.bucket_name, Key=self.subdir + file_name
+        )
+
+    def list_multipart_uploads(self, file_name: str) -> List[str]:
+        """
+        file_nameへの完了していないマルチパートアップロードのUploadIdを返す
+        """
+        upload_ids: List[str] = []
+        paginator = self.s3.get_paginator("list_multipart_uploads")
+        for page in paginator.paginate(
+            Bucket=self.bucket_name, Prefix=self.subdir + file_name
+        ):
+            for upload in page.get("Uploads", []):
+                if upload["Key"] == self.subdir + file_name:
+                    upload_ids.append(upload["UploadId"])
+        return upload_ids
+
+    def abort_multipart_upload(self, file_name: str, upload_id: str):
+        return self.s3.abort_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.subdir + file_name,
+            UploadId=upload_id,
+        )
+
+    def exists(self, file_name: str) -> bool:
+        try:
+            self.s3.head_object(Bucket=self.bucket_name, Key=self.subdir + file_name)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return False
+            raise e
+
+
+class MultipartWriter:
+    """
+    書き込んだデータをバイト列のまま溜め、part_sizeに達するたびにパートとしてアップロードする
+    - strはUTF-8にエンコードしてbytearrayに追記し、サイズは追記した分だけ数える
+    - アップロード時はbytearrayをそのままupload_partに渡し（コピーしない）、新しいbytearrayに切り替える
+    upload_id/parts/pendingを指定すると、途中まで進んだアップロードの続きから書き込めます
+
+    upload_concurrency > 0 の場合、パートはバックグラウンドのスレッドでアップロードされ、
+    クロールとアップロードが並行して進みます
+    - アップロード中のパートがupload_concurrency個を超える場合、writeは空きが出るまで待ちます
+    - 再試行しても失敗したパートがあれば、アップロードを中止してMultipartUploadAbortedを送出します
+    - partsはdrain()/close()の後にPartNumber順で揃います
+
+    compression（"gzip" | "zstd"）を指定すると、書き込んだデータを圧縮してからバッファに溜めます
+    （part_sizeは圧縮後のサイズ）。finish_frame()で圧縮のメンバー/フレームを完結させるため、
+    チェックポイントのpendingやwrite_rawで連結した圧縮データも続けて読めます
+    """
+
+    s3_client: S3_Client
+    file_name: str
+    upload_id: str
+    parts: List[Dict[str, Any]]
+    part_size: int
+    compression: Optional[str]
+
+    def __init__(
+        self,
+        s3_client: S3_Client,
+        file_name: str,
+        upload_id: Optional[str] = None,
+        parts: Optional[List[Dict[str, Any]]] = None,
+        part_size: int = DEFAULT_PART_SIZE,
+        pending: bytes = b"",
+        upload_concurrency: int = 0,
+        compression: Optional[str] = None,
+    ) -> None:
+        self.s3_client = s3_client
+        self.file_name = file_name
+        if upload_id is None:
+            upload_id = s3_client.create_multipart_upload(file_name)["UploadId"]
+        self.upload_id = upload_id
+        self.parts = parts if parts is not None else []
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        self._buffer: bytearray = bytearray(pending)
+        self._next_part_number: int = len(self.parts) + 1
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[threading.BoundedSemaphore] = None
+        if upload_concurrency > 0:
+            self._executor = ThreadPoolExecutor(max_workers=upload_concurrency)
+            self._slots = threading.BoundedSemaphore(upload_concurrency)
+        self._futures: List["Future[None]"] = []
+        self._lock = threading.Lock()
+
+        if compression is not None:
+            _new_compressor(compression)  # 未対応の形式はここで検出する
+        self.compression = compression
+        self._compressor: Any = None
+        self._frame_size: int = 0  # 現在のフレームに書き込んだ圧縮前のバイト数
+
+    @property
+    def part_number(self) -> int:
+        """
+        次にアップロードするパート番号
+        """
+        return self._next_part_number
+
+    @property
+    def buffered_size(self) -> int:
+        return len(self._buffer)
+
+    def pending(self) -> bytes:
+        """
+        まだアップロードしていないデータ（チェックポイントの保存用）
+        圧縮している場合は先にfinish_frame()、
+        バックグラウンドのアップロードがある場合は先にdrain()してください
+        """
+        return bytes(self._buffer)
+
+    def write(self, data: Union[str, bytes]) -> None:
+        if not data:
+            # gzipは空のデータでもヘッダーを出力するため、何もしない
+            return
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.compression is not None:
+            if self._compressor is None:
+                self._compressor = _new_compressor(self.compression)
+            self._frame_size += len(data)
+            data = self._compressor.compress(data)
+        self._buffer += data
+        if len(self._buffer) >= self.part_size:
+            self.flush()
+
+    def write_raw(self, data: bytes) -> None:
+        """
+        すでに圧縮されたデータ（例: シャードの出力）をそのまま追記する
+        """
+        self.finish_frame()
+        self._buffer += data
+        if len(self._buffer) >= self.part_size:
+            self.flush()
+
+    def finish_frame(self) -> None:
+        """
+        圧縮中のgzipメンバー/zstdフレームを完結させる
+        何も書き込んでいないフレームは出力しない（空のシャードは0バイトのまま）
+        """
+        if self._compressor is not None and self._frame_size > 0:
+            self._buffer += self._compressor.flush()
+        self._compressor = None
+        self._frame_size = 0
+
+    def flush(self) -> None:
+        """
+        溜まっているデータを1つのパートとしてアップロードする
+        最後のパート以外はMIN_PART_SIZE以上である必要があるため、通常はwriteに任せてください
+        """
+        if not self._buffer:
+            return
+        data: bytearray = self._buffer
+        self._buffer = bytearray()
+        self._upload_part(data)
+
+    def _upload_part(self, data: bytearray) -> None:
+        part_number: int = self._next_part_number
+        self._next_part_number += 1
+        if self._executor is None or self._slots is None:
+            self._send_part(part_number, data)
+            return
+
+        self._raise_if_failed()
+        self._slots.acquire()  # アップロード中のパートが多すぎる場合は待つ
+        self._futures.append(
+            self._executor.submit(self._send_part_in_background, part_number, data)
+        )
+
+    def _send_part(self, part_number: int, data: bytearray) -> None:
+        part_response: Any = self.s3_client.upload_part_with_retry(
+            self.file_name, part_number, self.upload_id, data
+        )
+        with self._lock:
+            self.parts.append(
+                {"PartNumber": part_number, "ETag": part_response["ETag"]}
+            )
+
+    def _send_part_in_background(self, part_number: int, data: bytearray) -> None:
+        try:
+            self._send_part(part_number, data)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    def _raise_if_failed(self) -> None:
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                self._abort_on_failure(future.exception())
+
+    def _abort_on_failure(self, error: Optional[BaseException]) -> None:
+        self.abort()
+        raise MultipartUploadAborted(
+            f"Upload of [{self.file_name}] aborted: {error!r}"
+        ) from error
+
+    def drain(self) -> None:
+        """
+        バックグラウンドでアップロード中のパートがすべて完了するまで待つ
+        """
+        for future in self._futures:
+            error: Optional[BaseException] = future.exception()
+            if error is not None:
+                self._abort_on_failure(error)
+        self._futures = []
+        self.parts.sort(key=lambda part: part["PartNumber"])
+
+    def close(self) -> None:
+        """
+        残りのデータを最後のパートとしてアップロードし、アップロードを完了する
+        """
+        self.finish_frame()
+        if self._buffer or self._next_part_number == 1:
+            data: bytearray = self._buffer
+            self._buffer = bytearray()
+            self._upload_part(data)
+        self.drain()
+        self._shutdown()
+        self.s3_client.complete_multipart_upload(
+            self.file_name, self.upload_id, self.parts
+        )
+
+    def abort(self) -> None:
+        self._buffer = bytearray()
+        self._compressor = None
+        self._shutdown()
+        self.s3_client.abort_multipart_upload(self.file_name, self.upload_id)
+
+    def _shutdown(self) -> None:
+        if self._executor is not None:
+            # 失敗時は残りのアップロードを待たない（python3.8にはcancel_futuresがない）
+            for future in self._futures:
+                future.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,77 @@
+import json
+from typing import Any, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from aws.s3 import S3_Client
+from shared.interfaces import CrawlCheckpoint
+
+# チェックポイントの保存先（PricingRegisterのS3トリガーの対象外のプレフィックス）
+CHECKPOINT_SUBDIR_PATH = "checkpoint/"
+
+
+class CrawlSuspended(Exception):
+    """
+    Lambdaの残り時間が少なくなったため、チェックポイントを保存してクロールを中断した
+    次の呼び出しで同じチェックポイントから再開します
+    """
+
+    file_name: str
+    cursor: int
+
+    def __init__(self, file_name: str, cursor: int) -> None:
+        super().__init__(f"Crawl of [{file_name}] suspended at [{cursor}]")
+        self.file_name = file_name
+        self.cursor = cursor
+
+
+class CheckpointStore:
+    """
+    S3にクロールの途中経過を保存する
+    <name>.json:   カーソルやマルチパートアップロードの状態（CrawlCheckpoint）
+    <name>.buffer: まだアップロードしていないパートのデータ
+    """
+
+    s3_client: S3_Client
+    name: str
+
+    def __init__(self, s3_client: S3_Client, name: str) -> None:
+        self.s3_client = s3_client
+        self.name = name
+
+    def load(self) -> Optional[Tuple[CrawlCheckpoint, bytes]]:
+        try:
+            checkpoint: CrawlCheckpoint = json.loads(
+                self.s3_client.get_object(self.name + ".json")["Body"].read()
+            )
+            buffer: bytes = self.s3_client.get_object(self.name + ".buffer")[
+                "Body"
+            ].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise e
+
+        return checkpoint, buffer
+
+    def save(self, checkpoint: CrawlCheckpoint, buffer: Any) -> None:
+        # 中断中の再開で整合性が崩れないように、バッファを先に保存する
+        self.s3_client.put_object(self.name + ".buffer", buffer)
+        self.s3_client.put_object(
+            self.name + ".json", json.dumps(checkpoint, ensure_ascii=False)
+        )
+        print(
+            f"Checkpoint saved [{self.name}] at [{checkpoint['cursor']}/"
+            f"{checkpoint['number_of_combinations']}]"
+        )
+
+    def clear(self) -> None:
+        self.s3_client.delete_object(self.name + ".json")
+        self.s3_client.delete_object(self.name + ".buffer")
+
+
+def open_checkpoint_store(s3_bucketname: str, name: str) -> CheckpointStore:
+    """
+    name: クロール対象ごとに一意な名前（例: printpac-label-seal）
+    """
+    return CheckpointStore(S3_Client(s3_bucketname, CHECKPOINT_SUBDIR_PATH), name)
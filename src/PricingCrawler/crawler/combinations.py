@@ -0,0 +1,148 @@
+import bisect
+from typing import (
+    Any,
+    Callable,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+    overload,
+)
+
+T = TypeVar("T")
+
+
+class Axis:
+    """
+    組み合わせの1つの軸（例: サイズ、印刷色）
+    """
+
+    options: Sequence[Any]
+    size: int
+
+    def __init__(self, options: Sequence[Any]) -> None:
+        self.options = options
+        self.size = len(options)
+
+    def choice(self, i: int) -> Tuple[Any, ...]:
+        return (self.options[i],)
+
+
+class Product:
+    """
+    複数の軸の直積（混合基数）
+    最後の軸が最も速く変わるため、ネストしたforループと同じ順番になります
+    """
+
+    children: List["Node"]
+    size: int
+
+    def __init__(self, *children: "Node") -> None:
+        self.children = list(children)
+        self.size = 1
+        for child in self.children:
+            self.size *= child.size
+
+    def choice(self, i: int) -> Tuple[Any, ...]:
+        digits: List[int] = []
+        for child in reversed(self.children):
+            i, digit = divmod(i, child.size)
+            digits.append(digit)
+
+        result: Tuple[Any, ...] = ()
+        for child, digit in zip(self.children, reversed(digits)):
+            result += child.choice(digit)
+        return result
+
+
+class Branch:
+    """
+    選択した値によって、その後の軸が変わる軸
+    例: 印刷用紙によって選べる加工オプションが異なる
+    """
+
+    options: Sequence[Any]
+    children: List["Node"]
+    size: int
+
+    def __init__(
+        self, options: Sequence[Any], child_of: Callable[[Any], "Node"]
+    ) -> None:
+        self.options = options
+        self.children = [child_of(option) for option in options]
+        # i番目の値までの組み合わせ数の累積（i番目の値を選んだ組み合わせは[_ends[i-1], _ends[i])）
+        self._ends: List[int] = []
+        total: int = 0
+        for child in self.children:
+            total += child.size
+            self._ends.append(total)
+        self.size = total
+
+    def choice(self, i: int) -> Tuple[Any, ...]:
+        k: int = bisect.bisect_right(self._ends, i)
+        start: int = self._ends[k - 1] if k > 0 else 0
+        return (self.options[k],) + self.children[k].choice(i - start)
+
+
+Node = Union[Axis, Product, Branch]
+
+
+class CombinationSpace(Generic[T]):
+    """
+    組み合わせをリストとして展開せずに扱うためのシーケンス
+    - len(): 組み合わせの総数（展開せずに計算）
+    - space[i]: i番目の組み合わせ（混合基数のインデックス計算）
+    - space[start:end]: 範囲を絞ったCombinationSpace（シャードやチェックポイントに使う）
+    - iter(space): 1件ずつ遅延して生成
+    build: 各軸で選んだ値のタプルから組み合わせ（例: SealCombination）を作る関数
+    """
+
+    root: Node
+    build: Callable[[Tuple[Any, ...]], T]
+
+    def __init__(
+        self,
+        root: Node,
+        build: Callable[[Tuple[Any, ...]], T],
+        start: int = 0,
+        stop: Optional[int] = None,
+    ) -> None:
+        self.root = root
+        self.build = build
+        self._start: int = start
+        self._stop: int = root.size if stop is None else stop
+
+    def __len__(self) -> int:
+        return max(0, self._stop - self._start)
+
+    @overload
+    def __getitem__(self, i: int) -> T: ...
+
+    @overload
+    def __getitem__(self, i: slice) -> "CombinationSpace[T]": ...
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("CombinationSpace does not support slice steps")
+            return CombinationSpace(
+                self.root,
+                self.build,
+                self._start + start,
+                self._start + max(start, stop),
+            )
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("combination index out of range")
+        return self.build(self.root.choice(self._start + i))
+
+    def __iter__(self) -> Iterator[T]:
+        for i in range(self._start, self._stop):
+            yield self.build(self.root.choice(i))
@@ -0,0 +1,457 @@
+import asyncio
+import datetime
+import json
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from aws.s3 import (
+    DEFAULT_PART_SIZE,
+    MultipartUploadAborted,
+    MultipartWriter,
+    S3_Client,
+)
+from data_convert.record_batch import PriceRecordBatch
+from shared.interfaces import CrawlCheckpoint, CrawlOptions, ShardSpec
+from .checkpoint import CheckpointStore, CrawlSuspended, open_checkpoint_store
+from .output_format import (
+    OutputFormat,
+    ParquetRecordWriter,
+    failed_file_name,
+    get_output_format,
+    output_extension,
+)
+from .sharding import (
+    SHARD_INDEX_STRIDE,
+    SHARD_SUBDIR_PATH,
+    shard_file_name,
+    shard_range,
+)
+from .rate_limit import (
+    DEFAULT_BURST,
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_MAX_RATE_PER_S,
+    DEFAULT_MIN_RATE_PER_S,
+    DEFAULT_RATE_PER_S,
+    configure_host_limit,
+)
+from .retry import (
+    DEFAULT_BASE_DELAY_S,
+    DEFAULT_MAX_ATTEMPTS,
+    DEFAULT_MAX_DELAY_S,
+    RetryPolicy,
+)
+from .utils import configure_http_client, get_http_client
+
+T = TypeVar("T")
+
+DEFAULT_MAX_IN_FLIGHT: int = 8  # 同時に送信するget_price.phpリクエストの上限
+# 中断を決めてから、未アップロードのパートをアップロードしてチェックポイントを保存するまでの余裕
+CHECKPOINT_SAVE_BUDGET_S: float = 45.0
+
+
+async def _fetch_in_order(
+    combinations: Iterable[T],
+    get_price: Callable[[T], Any],
+    on_result: Callable[[T, Any, Any], None],
+    max_in_flight: int,
+    should_stop: Callable[[], bool] = lambda: False,
+) -> bool:
+    """
+    最大max_in_flight件のリクエストを並行して送信し、結果は組み合わせの順番でon_resultに渡す
+    requestsはブロッキングなので、リクエストはスレッドプールで実行されます
+    should_stopがTrueを返した場合は新しいリクエストを送信せず、送信済みの結果を渡してから
+    Falseを返す（すべて処理した場合はTrue）
+    """
+    loop = asyncio.get_running_loop()
+    pending: Deque[Tuple[T, "asyncio.Future[Any]"]] = deque()
+
+    async def _consume_head() -> None:
+        item, future = pending.popleft()
+        try:
+            response: Any = await future
+        except Exception as e:
+            on_result(item, None, e)
+        else:
+            on_result(item, response, None)
+
+    completed: bool = True
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for item in combinations:
+            if should_stop():
+                completed = False
+                break
+            pending.append((item, loop.run_in_executor(executor, get_price, item)))
+            if len(pending) >= max_in_flight:
+                await _consume_head()
+        while pending:
+            await _consume_head()
+
+    return completed
+
+
+def _save_failed_combinations(
+    s3_client: S3_Client, file_name: str, failed: List[List[Any]]
+) -> None:
+    """
+    最後まで取得できなかった組み合わせを1行1件のJSONで出力ファイルと同じ場所に保存する
+    """
+    failed_name: str = failed_file_name(file_name)
+    lines: List[str] = [
+        json.dumps({"combination": item, "error": error}, ensure_ascii=False)
+        for item, error in failed
+    ]
+    s3_client.put_object(failed_name, "\n".join(lines) + "\n")
+    print(f"Saved [{len(failed)}] failed combinations to [{failed_name}]")
+
+
+def _load_checkpoint(
+    s3_client: S3_Client,
+    checkpoint_store: CheckpointStore,
+    number_of_combinations: int,
+    file_name: str,
+) -> Optional[Tuple[CrawlCheckpoint, bytes]]:
+    loaded: Optional[Tuple[CrawlCheckpoint, bytes]] = checkpoint_store.load()
+    if loaded is None:
+        return None
+
+    checkpoint, buffer = loaded
+    if checkpoint["file_name"] != file_name:
+        # 別の実行（例: 再開されなかった前日のクロール）のチェックポイントは再開せずに破棄する
+        print(f"Checkpoint of another run [{checkpoint['file_name']}]. Discarded.")
+        s3_client.abort_multipart_upload(
+            checkpoint["file_name"], checkpoint["upload_id"]
+        )
+        checkpoint_store.clear()
+        return None
+    if checkpoint["number_of_combinations"] != number_of_combinations:
+        # 前回の中断後に商品のオプションが変わったため、最初からやり直す
+        print("Checkpoint does not match the current combinations. Discarded.")
+        s3_client.abort_multipart_upload(
+            checkpoint["file_name"], checkpoint["upload_id"]
+        )
+        checkpoint_store.clear()
+        return None
+
+    print(
+        f"Resuming [{checkpoint['file_name']}] from checkpoint "
+        f"[{checkpoint['phase']}: {checkpoint['cursor']}]"
+    )
+    return checkpoint, buffer
+
+
+def prepare_crawl_output(
+    s3_bucketname: str,
+    s3_subdir: str,
+    prefix: str,
+    shard: Optional[ShardSpec] = None,
+    options: CrawlOptions = {},
+    run_id: Optional[str] = None,
+) -> Tuple[S3_Client, str, CheckpointStore]:
+    """
+    出力先のS3クライアント、ファイル名、チェックポイントの保存先を返す
+    ファイルの名：<相手-製品> _ <作成時間>.json
+    （options.output_formatとcompressionにより.ndjsonや.json.zstなど）
+    run_id: 中断・再開をまたいで同じ実行のID（作成時間の代わりにファイル名に使う）
+            チェックポイントのファイル名が異なる場合は別の実行のものとして破棄します
+    シャードの場合は結合前の断片としてSHARD_SUBDIR_PATHに出力します
+    """
+    if shard is None:
+        file_name: str = (
+            prefix
+            + (run_id or datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+            + output_extension(options.get("output_format"), options.get("compression"))
+        )
+        return (
+            S3_Client(s3_bucketname, s3_subdir),
+            file_name,
+            open_checkpoint_store(s3_bucketname, prefix.rstrip("_")),
+        )
+
+    file_name = shard_file_name(prefix, shard)
+    return (
+        S3_Client(s3_bucketname, SHARD_SUBDIR_PATH),
+        file_name,
+        open_checkpoint_store(s3_bucketname, file_name.split(".")[0]),
+    )
+
+
+def run_crawl(
+    s3_client: S3_Client,
+    file_name: str,
+    combinations: Sequence[T],
+    get_price: Callable[[T], Any],
+    convert: Callable[
+        [T, Any, List[int]], Union[PriceRecordBatch, List[PriceRecordBatch]]
+    ],
+    host: str,
+    options: CrawlOptions = {},
+    checkpoint_store: Optional[CheckpointStore] = None,
+    context: Any = None,
+    shard: Optional[ShardSpec] = None,
+) -> str:
+    """
+    すべての組み合わせの価格を取得し、BigQuery形式に変換してS3へマルチパートアップロードする
+    combinations:     クロールする組み合わせ（インデックスでアクセスできるCombinationSpaceなど）
+    get_price:        1つの組み合わせに対してget_price.phpへリクエストする関数
+    convert:          get_priceの戻り値をBigQuery形式のレコード（PriceRecordBatch）に変換する関数
+                      1つの組み合わせから複数の価格表を取得した場合はPriceRecordBatchのリスト
+    host:             リクエスト先のホスト（このホストへのリクエストにレート制限がかかります）
+    options:          並行数やレート制限、再試行などのクロール設定
+    checkpoint_store: 中断・再開に使うチェックポイントの保存先
+    context:          Lambdaのcontext（残り時間の確認に使います）
+    shard:            指定された場合、組み合わせのうちこのシャードの範囲だけをクロールし、
+                      波括弧なしのJSONの断片として出力します（sharding.merge_shardsで結合）
+
+    失敗した組み合わせはRetryPolicyで再試行し、それでも失敗したものは最後にもう一度だけ
+    まとめて再リクエストします。最終的に失敗した組み合わせは<ファイル名>_failed.jsonlに保存されます
+
+    Lambdaの残り時間がcheckpoint_margin_sを切った場合は、カーソル・アップロード済みのパート・
+    未アップロードのバッファをcheckpoint_storeに保存してCrawlSuspendedを送出します
+    （その後に失敗したリクエストは再試行せず、失敗した組み合わせとして最後の再リクエストに回します）
+    次の呼び出しではチェックポイントから再開し、同じファイルへのアップロードを完了させます
+
+    options.upload_concurrency > 0 の場合、パートはバックグラウンドでアップロードされ、
+    価格の取得と並行して進みます
+    options.output_format="parquet"の場合はParquetで出力します（チェックポイント・シャードは不可）
+    戻り値: アップロードしたファイル名
+    """
+    max_in_flight: int = max(1, options.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT))
+    max_concurrency: int = options.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+    configure_host_limit(
+        host,
+        rate_per_s=options.get("rate_per_s", DEFAULT_RATE_PER_S),
+        burst=options.get("burst", DEFAULT_BURST),
+        max_concurrency=max_concurrency,
+        adaptive=options.get("adaptive", False),
+        min_rate_per_s=options.get("min_rate_per_s", DEFAULT_MIN_RATE_PER_S),
+        max_rate_per_s=options.get("max_rate_per_s", DEFAULT_MAX_RATE_PER_S),
+    )
+    if get_http_client().pool_maxsize < max_concurrency:
+        configure_http_client(pool_maxsize=max_concurrency)
+
+    retry_policy = RetryPolicy(
+        max_attempts=options.get("retry_max_attempts", DEFAULT_MAX_ATTEMPTS),
+        base_delay_s=options.get("retry_base_delay_s", DEFAULT_BASE_DELAY_S),
+        max_delay_s=options.get("retry_max_delay_s", DEFAULT_MAX_DELAY_S),
+    )
+
+    # 中断を決めた後は再試行しないため、送信済みのリクエストは1回分のタイムアウト（接続+読み込み）で終わる
+    checkpoint_margin_ms: float = (
+        options.get(
+            "checkpoint_margin_s",
+            sum(get_http_client().timeout) + CHECKPOINT_SAVE_BUDGET_S,
+        )
+        * 1000
+    )
+
+    output_format: OutputFormat = get_output_format(options.get("output_format"))
+    if output_format.columnar:
+        # Parquetはフッターにファイル全体のメタデータを書くため、途中から再開・結合できない
+        if shard is not None:
+            raise ValueError("Parquet output does not support shards")
+        if checkpoint_store is not None:
+            print("Checkpoints are disabled for Parquet output")
+            checkpoint_store = None
+
+    def _should_stop() -> bool:
+        if context is None or checkpoint_store is None:
+            return False
+        return context.get_remaining_time_in_millis() < checkpoint_margin_ms
+
+    def _get_price_with_retry(item: T) -> Any:
+        return retry_policy.call(get_price, item, should_stop=_should_stop)
+
+    index_offset: int = 0
+    if shard is not None:
+        start, end = shard_range(len(combinations), shard)
+        # CombinationSpaceの場合は展開せずに範囲だけを絞る
+        combinations = combinations[start:end]
+        index_offset = shard["shard_index"] * SHARD_INDEX_STRIDE
+        print(
+            f"[Shard {shard['shard_index']}/{shard['shard_count']}] "
+            f"combinations [{start}:{end}]"
+        )
+
+    number_of_combinations: int = len(combinations)
+    ten_pct: int = max(1, math.ceil(number_of_combinations / 10))
+    print("[Number of Combinations] ", number_of_combinations)
+
+    resumed: Optional[Tuple[CrawlCheckpoint, bytes]] = None
+    if checkpoint_store is not None:
+        resumed = _load_checkpoint(
+            s3_client, checkpoint_store, number_of_combinations, file_name
+        )
+
+    state: CrawlCheckpoint
+    pending: bytes
+    if resumed is not None:
+        state, pending = resumed
+    else:
+        upload_stream = s3_client.create_multipart_upload(file_name)
+        print(f"Multipart upload initiated with ID: {upload_stream['UploadId']}")
+        state = {
+            "file_name": file_name,
+            "upload_id": upload_stream["UploadId"],
+            "parts": [],
+            "number_of_combinations": number_of_combinations,
+            "phase": "main",
+            "cursor": 0,
+            "retry_items": [],
+            "failed": [],
+            "index": index_offset,
+            "count": 0,
+            "written": False,
+        }
+        pending = b""
+
+    file_name = state["file_name"]
+    writer = MultipartWriter(
+        s3_client,
+        file_name,
+        state["upload_id"],
+        state["parts"],
+        options.get("part_size", DEFAULT_PART_SIZE),
+        pending,
+        options.get("upload_concurrency", 0),
+        # Parquetは列ごとに圧縮するため、ファイル全体は圧縮しない
+        None if output_format.columnar else options.get("compression"),
+    )
+    columnar_writer: Optional[ParquetRecordWriter] = None
+    if output_format.columnar:
+        columnar_writer = ParquetRecordWriter(writer, options.get("compression"))
+    if resumed is None and shard is None:
+        writer.write(output_format.header)
+    idx: List[int] = [state["index"]]
+    # 区切り文字の要否はidxから判断しない（idxを進めた後に変換が失敗する場合があるため）
+    # 中断前のチェックポイントにない場合は、idxが進んでいればレコードを書き込んでいる
+    state["written"] = state.get("written", idx[0] > index_offset)
+
+    def _on_result(item: T, response: Any, error: Any) -> None:
+        done: int = state["cursor"]
+        state["cursor"] += 1
+        if state["phase"] == "main":
+            if done == number_of_combinations - 1:
+                print("Progress: 100%")
+            elif done % ten_pct == 0:
+                print("Progress: {}%".format((done * 10 / ten_pct)))
+
+        if error is not None:
+            print("Error when requesting item with info: ", item, error)
+            state["failed"].append([item, repr(error)])
+            return
+
+        try:
+            if response is None:
+                print("No data returned")
+                return
+
+            before: int = idx[0]
+            try:
+                converted: Union[PriceRecordBatch, List[PriceRecordBatch]] = convert(
+                    item, response, idx
+                )
+            except Exception:
+                # 途中まで進めたインデックスを戻す（書き込まれないレコードの番号を空けない）
+                idx[0] = before
+                raise
+            for converted_data in (
+                converted if isinstance(converted, list) else [converted]
+            ):
+                if not converted_data:
+                    continue
+                if columnar_writer is not None:
+                    columnar_writer.write(converted_data)
+                    continue
+                if state["written"]:
+                    writer.write(output_format.separator)
+                writer.write(output_format.encode(converted_data))
+                state["written"] = True
+            state["count"] += 1
+        except MultipartUploadAborted as e:
+            raise e
+        except Exception as e:
+            print("Error when requesting item with info: ", item, e)
+            state["failed"].append([item, repr(e)])
+
+    def _suspend() -> None:
+        state["index"] = idx[0]
+        # 圧縮のフレームを閉じ、アップロード中のパートが完了してからpartsを保存する
+        writer.finish_frame()
+        writer.drain()
+        if checkpoint_store is not None:
+            checkpoint_store.save(state, writer.pending())
+        raise CrawlSuspended(file_name, state["cursor"])
+
+    try:
+        if state["phase"] == "main":
+            remaining: Iterable[T] = (
+                combinations[i] for i in range(state["cursor"], number_of_combinations)
+            )
+            if not asyncio.run(
+                _fetch_in_order(
+                    remaining,
+                    _get_price_with_retry,
+                    _on_result,
+                    max_in_flight,
+                    _should_stop,
+                )
+            ):
+                _suspend()
+
+            # 失敗した組み合わせだけを再リクエストする
+            state["phase"] = "retry"
+            state["cursor"] = 0
+            if options.get("retry_failed_pass", True):
+                state["retry_items"] = [item for item, _ in state["failed"]]
+                state["failed"] = []
+
+        if state["retry_items"]:
+            remaining_retry: List[T] = state["retry_items"][state["cursor"] :]
+            print(f"[Retry] Re-requesting [{len(remaining_retry)}] failed combinations")
+            if not asyncio.run(
+                _fetch_in_order(
+                    remaining_retry,
+                    _get_price_with_retry,
+                    _on_result,
+                    max_in_flight,
+                    _should_stop,
+                )
+            ):
+                _suspend()
+
+        # JSONを最終化（シャードの場合は結合時に閉じる）
+        if shard is None:
+            writer.write(output_format.footer)
+        if columnar_writer is not None:
+            columnar_writer.close()
+        writer.close()
+    except MultipartUploadAborted as e:
+        # アップロードが中止されたため、このチェックポイントからは再開できない
+        if checkpoint_store is not None:
+            checkpoint_store.clear()
+        raise e
+
+    if state["failed"]:
+        _save_failed_combinations(s3_client, file_name, state["failed"])
+    if checkpoint_store is not None and resumed is not None:
+        checkpoint_store.clear()
+
+    print(
+        "Success rate: {}%".format(
+            round(state["count"] * 100 / max(1, number_of_combinations), 2)
+        )
+    )
+    return file_name
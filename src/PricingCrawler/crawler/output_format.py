@@ -0,0 +1,236 @@
+import datetime
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, get_type_hints
+
+from aws.s3 import COMPRESSION_EXTENSIONS, MultipartWriter
+from data_convert.record_batch import VARIABLE_COLUMNS, PriceRecordBatch
+from shared.interfaces import PriceSchema
+
+PARQUET_ROW_GROUP_SIZE: int = 50 * 1000  # 1つのRow Groupに溜めるレコード数
+DATE_COLUMNS: List[str] = ["start_date"]  # PriceSchemaではstrだが、BigQueryではDATE
+
+
+class OutputFormat(ABC):
+    """
+    クロール結果のファイル形式
+    header + encode(レコード) + separator + encode(レコード) + ... + footer の順に書き込まれます
+    シャードの場合はheaderとfooterを除いた断片を出力し、結合時に付けます
+    """
+
+    extension: str
+    header: bytes
+    separator: bytes
+    footer: bytes
+    columnar: bool = False  # Trueの場合はencodeではなくParquetRecordWriterで書き込む
+
+    @abstractmethod
+    def encode(self, converted_data: PriceRecordBatch) -> str:
+        """
+        レコードをheaderとfooterの間に書き込む文字列にする
+        """
+
+
+class JsonObjectFormat(OutputFormat):
+    """
+    1つのJSONオブジェクト（{"1": {...}, "2": {...}}）
+    """
+
+    extension: str = ".json"
+    header: bytes = b"{"
+    separator: bytes = b","
+    footer: bytes = b"}"
+
+    def encode(self, converted_data: PriceRecordBatch) -> str:
+        return converted_data.encode_json_members()  # ブラケットなし
+
+
+class NdjsonFormat(OutputFormat):
+    """
+    1行に1レコード（PriceSchema）のNDJSON
+    レコードの連番はキーとして出力されません
+    PricingRegisterが1行ずつ読め、そのままBigQueryのロードジョブにも使えます
+    """
+
+    extension: str = ".ndjson"
+    header: bytes = b""
+    separator: bytes = b""
+    footer: bytes = b""
+
+    def encode(self, converted_data: PriceRecordBatch) -> str:
+        return converted_data.encode_ndjson()
+
+
+class ParquetFormat(OutputFormat):
+    """
+    PriceSchemaの列を持つParquet（pyarrowが必要）
+    - 圧縮はParquetの列ごとに行うため、ファイル名に.gz/.zstは付きません
+    - フッターにファイル全体のメタデータが必要なため、チェックポイントとシャードには対応していません
+    """
+
+    extension: str = ".parquet"
+    header: bytes = b""
+    separator: bytes = b""
+    footer: bytes = b""
+    columnar: bool = True
+
+    def encode(self, converted_data: PriceRecordBatch) -> str:
+        raise TypeError("Parquet output is written with ParquetRecordWriter")
+
+
+OUTPUT_FORMATS: Dict[str, OutputFormat] = {
+    "json": JsonObjectFormat(),
+    "ndjson": NdjsonFormat(),
+    "parquet": ParquetFormat(),
+}
+
+
+def get_output_format(output_format: Optional[str] = None) -> OutputFormat:
+    """
+    output_format: "json"（既定） | "ndjson" | "parquet"
+    """
+    if output_format is None:
+        return OUTPUT_FORMATS["json"]
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format [{output_format}]")
+    return OUTPUT_FORMATS[output_format]
+
+
+def output_extension(
+    output_format: Optional[str] = None, compression: Optional[str] = None
+) -> str:
+    """
+    例: ".json", ".ndjson.zst", ".parquet"
+    """
+    file_format: OutputFormat = get_output_format(output_format)
+    if file_format.columnar:
+        return file_format.extension
+    return file_format.extension + COMPRESSION_EXTENSIONS.get(compression or "", "")
+
+
+def failed_file_name(file_name: str) -> str:
+    """
+    例: printpac-sticker_2024-07-31-05-54-53.json
+     -> printpac-sticker_2024-07-31-05-54-53_failed.jsonl
+    PricingRegisterが登録対象として読まない拡張子にする
+    """
+    return file_name.split(".")[0] + "_failed.jsonl"
+
+
+def _to_date(value: Any) -> Any:
+    return datetime.date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _to_int(value: Any) -> Any:
+    # get_price.phpの価格は文字列で返ってくることがある
+    return int(value) if value is not None else None
+
+
+def _parquet_columns() -> Dict[str, Any]:
+    """
+    PriceSchemaの型から列の型を決める（registers/bigquery_schema.TABLE_SCHEMAと同じ列）
+    戻り値: {列名: (pyarrowの型, 値の変換関数)}
+    """
+    import pyarrow as pa
+
+    columns: Dict[str, Any] = {}
+    for name, hint in get_type_hints(PriceSchema).items():
+        if name in DATE_COLUMNS:
+            columns[name] = (pa.date32(), _to_date)
+        elif hint is bool:
+            columns[name] = (pa.bool_(), None)
+        elif hint is int:
+            columns[name] = (pa.int64(), _to_int)
+        else:
+            columns[name] = (pa.string(), None)
+    return columns
+
+
+class _MultipartSink:
+    """
+    pyarrowの出力先として、書き込まれたバイト列をMultipartWriterに渡すファイルライクオブジェクト
+    """
+
+    closed: bool
+
+    def __init__(self, writer: MultipartWriter) -> None:
+        self._writer = writer
+        self._position: int = 0
+        self.closed = False
+
+    def write(self, data: Any) -> int:
+        data = bytes(data)
+        self._writer.write(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class ParquetRecordWriter:
+    """
+    変換したレコードを列ごとに溜め、row_group_size件に達するたびにRow GroupとしてParquetに書き込む
+    ParquetのバイトはMultipartWriterに流れ、part_sizeごとにアップロードされます
+    compression: Parquetの列の圧縮形式（"zstd" | "gzip" | 未指定の場合はsnappy）
+    """
+
+    def __init__(
+        self,
+        writer: MultipartWriter,
+        compression: Optional[str] = None,
+        row_group_size: int = PARQUET_ROW_GROUP_SIZE,
+    ) -> None:
+        import pyarrow as pa  # Parquetで出力する場合だけ読み込む
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._columns: Dict[str, Any] = _parquet_columns()
+        self._schema = pa.schema(
+            [(name, arrow_type) for name, (arrow_type, _) in self._columns.items()]
+        )
+        self._sink = _MultipartSink(writer)
+        self._parquet_writer = pq.ParquetWriter(
+            pa.PythonFile(self._sink, mode="w"),
+            self._schema,
+            compression=compression or "snappy",
+        )
+        self._row_group_size: int = row_group_size
+        self._values: Dict[str, List[Any]] = {name: [] for name in self._columns}
+        self._rows: int = 0
+
+    def write(self, converted_data: PriceRecordBatch) -> None:
+        """
+        組み合わせで共通の列は1回だけ変換し、行数分を列に追加する
+        """
+        for name, (_, convert) in self._columns.items():
+            if name in VARIABLE_COLUMNS:
+                self._values[name].extend(converted_data.column(name))
+                continue
+            value: Any = converted_data.static_row.get(name)
+            if convert is not None:
+                value = convert(value)
+            self._values[name].extend([value] * len(converted_data))
+        self._rows += len(converted_data)
+        if self._rows >= self._row_group_size:
+            self._flush_row_group()
+
+    def _flush_row_group(self) -> None:
+        if self._rows == 0:
+            return
+        table = self._pa.Table.from_pydict(self._values, schema=self._schema)
+        self._parquet_writer.write_table(table)
+        self._values = {name: [] for name in self._columns}
+        self._rows = 0
+
+    def close(self) -> None:
+        """
+        残りのレコードとフッターを書き込む（この後でMultipartWriter.close()を呼んでください）
+        """
+        self._flush_row_group()
+        self._parquet_writer.close()
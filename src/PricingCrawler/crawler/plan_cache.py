@@ -0,0 +1,170 @@
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Callable, Dict, Optional
+
+import requests
+from botocore.exceptions import ClientError
+from bs4 import BeautifulSoup, SoupStrainer
+from requests import Response
+
+from aws.s3 import S3_Client
+from shared.interfaces import CrawlOptions, OptionPlan
+from .utils import get_http_client, parse_webpage
+
+# オプションのキャッシュの保存先（PricingRegisterのS3トリガーの対象外のプレフィックス）
+PLAN_SUBDIR_PATH = "plans/"
+# Lambdaのウォームスタート時はS3から読み込まずに/tmpのキャッシュを使う
+LOCAL_PLAN_DIR: str = os.path.join(tempfile.gettempdir(), "pricing-crawler-plans")
+
+
+def options_hash(options: Dict[str, Any]) -> str:
+    """
+    解析したオプションの内容のハッシュ（キーの順番に依存しない）
+    """
+    encoded: bytes = json.dumps(options, sort_keys=True, ensure_ascii=False).encode(
+        "utf-8"
+    )
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class PlanCache:
+    """
+    オプションのページの解析結果（OptionPlan）をS3と/tmpに保存する
+    <name>.json: OptionPlan
+    """
+
+    s3_client: S3_Client
+    name: str
+    local_dir: str
+
+    def __init__(
+        self, s3_client: S3_Client, name: str, local_dir: str = LOCAL_PLAN_DIR
+    ) -> None:
+        self.s3_client = s3_client
+        self.name = name
+        self.local_dir = local_dir
+
+    def _local_path(self) -> str:
+        return os.path.join(self.local_dir, self.name + ".json")
+
+    def _load_local(self) -> Optional[OptionPlan]:
+        try:
+            with open(self._local_path(), "r", encoding="utf-8") as file:
+                plan: OptionPlan = json.load(file)
+                return plan
+        except (OSError, ValueError):
+            return None
+
+    def _save_local(self, plan: OptionPlan) -> None:
+        try:
+            os.makedirs(self.local_dir, exist_ok=True)
+            with open(self._local_path(), "w", encoding="utf-8") as file:
+                json.dump(plan, file, ensure_ascii=False)
+        except OSError as e:
+            # /tmpに書けなくてもS3のキャッシュは使える
+            print(f"Could not save plan [{self.name}] to [{self.local_dir}]: {e}")
+
+    def load(self) -> Optional[OptionPlan]:
+        plan: Optional[OptionPlan] = self._load_local()
+        if plan is not None:
+            return plan
+        try:
+            plan = json.loads(
+                self.s3_client.get_object(self.name + ".json")["Body"].read()
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise e
+        if plan is not None:
+            self._save_local(plan)
+        return plan
+
+    def save(self, plan: OptionPlan) -> None:
+        self.s3_client.put_object(
+            self.name + ".json", json.dumps(plan, ensure_ascii=False)
+        )
+        self._save_local(plan)
+        print(f"Plan saved [{self.name}] ({plan['options_hash'][:12]})")
+
+
+def open_plan_cache(
+    s3_bucketname: str, name: str, options: CrawlOptions = {}
+) -> Optional[PlanCache]:
+    """
+    name: クロール対象ごとに一意な名前（例: printpac-label-seal）
+    options.plan_cache=Falseの場合はNone（毎回ページを解析する）
+    """
+    if not options.get("plan_cache", True):
+        return None
+    return PlanCache(S3_Client(s3_bucketname, PLAN_SUBDIR_PATH), name)
+
+
+def load_options(
+    url: str,
+    parse: Callable[[BeautifulSoup], Dict[str, Any]],
+    plan_cache: Optional[PlanCache] = None,
+    parse_only: Optional[SoupStrainer] = None,
+) -> Dict[str, Any]:
+    """
+    オプションのページを取得して解析する（parse: ページ -> JSONにできるオプション）
+    plan_cacheがある場合:
+    - 前回のETag/Last-Modifiedで条件付きGETし、304なら解析せずに前回のオプションを返す
+    - 解析したオプションが前回と異なる場合は警告を出す
+      （shared/constants.pyやクローラーのマッピングの見直しが必要かもしれません）
+    """
+    cached: Optional[OptionPlan] = None
+    if plan_cache is not None:
+        cached = plan_cache.load()
+        if cached is not None and cached["url"] != url:
+            cached = None
+
+    headers: Dict[str, str] = {}
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        response: Response = get_http_client().get(url, headers=headers)
+        if cached is not None and response.status_code == 304:
+            print(
+                f"[{url}] not modified. Reusing options from [{cached['updated_at']}]"
+            )
+            return cached["options"]
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"An error occurred: {e}")
+        raise e
+
+    options: Dict[str, Any] = parse(parse_webpage(response.content, parse_only))
+    if plan_cache is None:
+        return options
+
+    # キャッシュから読み込んだ場合と同じ型（JSON）にそろえる
+    options = json.loads(json.dumps(options, ensure_ascii=False))
+    plan: OptionPlan = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "options_hash": options_hash(options),
+        "options": options,
+        "updated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    if cached is not None and cached["options_hash"] != plan["options_hash"]:
+        print(
+            f"[Warning] Options of [{url}] changed since [{cached['updated_at']}]. "
+            "Review the mapping tables in shared/constants.py"
+        )
+    if (
+        cached is None
+        or cached["options_hash"] != plan["options_hash"]
+        or cached["etag"] != plan["etag"]
+        or cached["last_modified"] != plan["last_modified"]
+    ):
+        plan_cache.save(plan)
+    return options
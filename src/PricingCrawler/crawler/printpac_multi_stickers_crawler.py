@@ -1,24 +1,37 @@
-import time
-import datetime
-import math
 import json
-import requests
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 from requests import Response
-from bs4 import BeautifulSoup, Tag, ResultSet
 from aws.s3 import S3_Client
 
 from data_convert.convert_bigquery_format import (
-    convert_multi_sticker_price_for_bigquery,
+    convert_price_cells_for_bigquery,
+    get_start_date,
+    multi_sticker_static_row,
 )
-from shared.constants import ProductCategory
+from data_convert.price_response import PriceCell, decode_sticker_price_response
+from data_convert.record_batch import PriceRecordBatch
+from shared.constants import PRINTPAC_HOST, ProductCategory
 from shared.interfaces import (
+    CrawlOptions,
+    ShardSpec,
     OptionInfo,
+    PriceSchema,
     MultiStickerCombination,
-    MultiStickerPrice,
     MultiStickerRequestPayload,
 )
-from .utils import extract_id, get_webpage, get_first_value_by_attr
+from .utils import (
+    OPTION_INPUTS,
+    extract_id,
+    get_http_client,
+    group_radio_options,
+)
+from .checkpoint import CheckpointStore, CrawlSuspended
+from .combinations import Axis, Branch, CombinationSpace, Product
+from .engine import prepare_crawl_output, run_crawl
+from .plan_cache import PlanCache, load_options, open_plan_cache
+
+# ファイルの名：<相手-製品> _ <作成時間>.json
+FILE_PREFIX: str = "printpac-multi-sticker_"
 
 
 """
@@ -109,59 +122,29 @@ def _filter_halfcut_option(
 """
 
 
-def _get_all_sizes(html: BeautifulSoup) -> List[OptionInfo]:
+# options: group_radio_options()でname属性ごとにまとめたラジオボタン
+
+
+def _get_all_sizes(options: Dict[str, List[OptionInfo]]) -> List[OptionInfo]:
     # [
     # {"id": "14", "name": "ハガキサイズ（100×148mm）"},
     # {"id": "4", "name": "A4サイズ（210×297mm）"},
     # ]
-    sizes: List[OptionInfo] = []
-    elements: ResultSet[Tag] = html.find_all("input", type="radio")
-    for input in elements:
-        name: str = get_first_value_by_attr(input, "name")
-        if name == "size":
-            id: str = get_first_value_by_attr(input, "value")
-            sizes.append({"id": id, "name": name})
-
-    return sizes
+    return options.get("size", [])
 
 
 # kami_mei_id
-def _get_print_colors(html: BeautifulSoup) -> List[OptionInfo]:
+def _get_print_colors(options: Dict[str, List[OptionInfo]]) -> List[OptionInfo]:
     # CMYK印刷 | RGB+α印刷
-    print_colors: List[OptionInfo] = []
-    elements: ResultSet[Tag] = html.find_all("input", type="radio")
-    for input in elements:
-        name: str = get_first_value_by_attr(input, "name")
-        if name == "print_color":
-            id: str = get_first_value_by_attr(input, "value")
-            print_colors.append({"id": id, "name": name})
-
-    return print_colors
-
-
-def _get_all_papers(html) -> List[OptionInfo]:
-    papers: List[OptionInfo] = []
-    elements: ResultSet[Tag] = html.find_all("input", type="radio")
-    for input in elements:
-        name: str = get_first_value_by_attr(input, "name")
-        if name == "paper":
-            id: str = get_first_value_by_attr(input, "value")
-
-            papers.append({"id": id, "name": name})
+    return options.get("print_color", [])
 
-    return papers
 
+def _get_all_papers(options: Dict[str, List[OptionInfo]]) -> List[OptionInfo]:
+    return options.get("paper", [])
 
-def _get_halfcut_amount(html) -> List[OptionInfo]:
-    half_cut_amount: List[OptionInfo] = []
-    elements: ResultSet[Tag] = html.find_all("input", type="radio")
-    for input in elements:
-        name: str = get_first_value_by_attr(input, "name")
-        if name == "halfcat":
-            id: str = get_first_value_by_attr(input, "value")
-            half_cut_amount.append({"id": id, "name": name})
 
-    return half_cut_amount
+def _get_halfcut_amount(options: Dict[str, List[OptionInfo]]) -> List[OptionInfo]:
+    return options.get("halfcat", [])
 
 
 """ SECTION ENDED """
@@ -172,28 +155,38 @@ def _create_all_combinations(
     print_colors: List[OptionInfo],
     papers: List[OptionInfo],
     halfcut_options: List[OptionInfo],
-) -> List[MultiStickerCombination]:
-    combinations: List[MultiStickerCombination] = []
-
-    for size_id in extract_id(all_sizes):
-        for color_id in extract_id(print_colors):
-            for paper_id in extract_id(papers):
-                process_opts: List[OptionInfo] = _filter_process_opts_on_paper_id(
-                    paper_id
-                )
-                for process_opt in process_opts:
-                    for halfcut_opt in _filter_halfcut_option(halfcut_options, size_id):
-                        item: MultiStickerCombination = {
-                            "size_id": size_id,
-                            "print_color_id": color_id,
-                            "half_cut_amount_id": halfcut_opt["id"],
-                            "paper_id": paper_id,
-                            "processing_opt_id": process_opt["id"],
-                            "processing_opt_name": process_opt["name"],
-                        }
-                        combinations.append(item)
-
-    return combinations
+) -> CombinationSpace[MultiStickerCombination]:
+    """
+    サイズ × 印刷色 × 用紙 × 加工（用紙ごとに異なる） × ハーフカット（サイズごとに異なる）
+    組み合わせはリストに展開せず、インデックスから必要な時に生成する
+    """
+    color_ids: List[str] = extract_id(print_colors)
+    paper_ids: List[str] = extract_id(papers)
+
+    def _colors_of(size_id: str) -> Product:
+        halfcut_axis = Axis(_filter_halfcut_option(halfcut_options, size_id))
+        return Product(
+            Axis(color_ids),
+            Branch(
+                paper_ids,
+                lambda paper_id: Product(
+                    Axis(_filter_process_opts_on_paper_id(paper_id)), halfcut_axis
+                ),
+            ),
+        )
+
+    def _build(choice: Tuple[Any, ...]) -> MultiStickerCombination:
+        size_id, color_id, paper_id, process_opt, halfcut_opt = choice
+        return {
+            "size_id": size_id,
+            "print_color_id": color_id,
+            "half_cut_amount_id": halfcut_opt["id"],
+            "paper_id": paper_id,
+            "processing_opt_id": process_opt["id"],
+            "processing_opt_name": process_opt["name"],
+        }
+
+    return CombinationSpace(Branch(extract_id(all_sizes), _colors_of), _build)
 
 
 def _get_price(data: MultiStickerCombination) -> Response:
@@ -213,160 +206,120 @@ def _get_price(data: MultiStickerCombination) -> Response:
         "irokazu_id": "1",  # 固定
         "tax_flag": False,
     }
-    response: Response = requests.post(
+    response: Response = get_http_client().post(
         url,
         headers=headers,
         data=request_payload,
     )
-    if response.ok:
-        return response
-
-    else:
+    if not response.ok:
         print("Request failed with status code:", response.status_code)
-        raise
+        # ステータスコードを含むHTTPErrorを送出する
+        response.raise_for_status()
+    return response
+
+
+def _convert_response(
+    item: MultiStickerCombination, r: Response, idx: List[int]
+) -> PriceRecordBatch:
+    """
+    response: {
+        [UNIT]: {
+            [EIGYO]: {
+                "1": { # "1" 固定
+                    "s_id": "44246959",
+                    "t_id": "797287",
+                    "price": "1110",
+                    "price2": "1420",
+                    "tax": 101,
+                    "tax2": 129
+                }
+            }
+    }
+    """
+    # 価格のセルは固定のキー"1"の下にあるため、デコード時に"1"を外した価格表にする
+    res_data: Dict[str, Dict[str, PriceCell]] = decode_sticker_price_response(r.content)
+
+    # 組み合わせで共通の列は1回だけ計算し、各セルではday/set/価格だけを埋める
+    static_row: PriceSchema = multi_sticker_static_row(
+        ProductCategory.SEAL,
+        "multi",
+        item["processing_opt_name"],
+        item["paper_id"],
+        item["size_id"],
+        item["print_color_id"],
+        item["half_cut_amount_id"],
+        get_start_date(),
+    )
+    return convert_price_cells_for_bigquery(static_row, res_data, idx)
 
 
 def _crawl_multi_sicker_prices(
     s3_client: S3_Client,
     file_name: str,
     save_combinations: bool = False,
-    interval_s: float = 0.1,
-) -> None:
+    options: CrawlOptions = {},
+    checkpoint_store: Optional[CheckpointStore] = None,
+    context: Any = None,
+    shard: Optional[ShardSpec] = None,
+    plan_cache: Optional[PlanCache] = None,
+) -> str:
     url = "https://www.printpac.co.jp/contents/lineup/sticker_multi/"
-    html: BeautifulSoup = get_webpage(url)
+    # ページが前回から変わっていなければ、解析せずに前回のオプションを使う
+    options_by_name: Dict[str, List[OptionInfo]] = load_options(
+        url, group_radio_options, plan_cache, parse_only=OPTION_INPUTS
+    )
 
-    combinations: List[MultiStickerCombination] = _create_all_combinations(
-        all_sizes=_get_all_sizes(html),
-        halfcut_options=_get_halfcut_amount(html),
-        papers=_get_all_papers(html),
-        print_colors=_get_print_colors(html),
+    combinations: CombinationSpace[MultiStickerCombination] = _create_all_combinations(
+        all_sizes=_get_all_sizes(options_by_name),
+        halfcut_options=_get_halfcut_amount(options_by_name),
+        papers=_get_all_papers(options_by_name),
+        print_colors=_get_print_colors(options_by_name),
     )
 
     if save_combinations == True:
         with open("multi_sticker_combination.txt", "w") as file:
-            json.dump(combinations, file, indent=4, ensure_ascii=False)
+            json.dump(list(combinations), file, indent=4, ensure_ascii=False)
 
-    """
-        res_data: {
-            [unit] : {
-                [eigyo]: Dict[str,Union[str,int]]
-            }
-        }
-    """
-    count = 0
-    part_number = 1
-    chunk_size = 64 * 1024 * 1024  # 64 MB
-    parts = []
-    idx: List[int] = [0]
-
-    number_of_combinations: int = len(combinations)
-    ten_pct: int = math.ceil(number_of_combinations / 10)
-    print("[Number of Combinations] ", number_of_combinations)
-
-    upload_stream = s3_client.create_multipart_upload(file_name)
-    upload_id = upload_stream["UploadId"]
-    print(f"Multipart upload initiated with ID: {upload_id}")
-
-    buffer = "{"
-    for item in combinations:
-        if count == (number_of_combinations - 1):
-            print("Progress: 100%")
-        elif count % ten_pct == 0:
-            print("Progress: {}%".format((count * 10 / ten_pct)))
-
-        try:
-            r: Response = _get_price(item)
-            if r is None:
-                print("No data returned")
-            else:
-                """
-                response: {
-                    [UNIT]: {
-                        [EIGYO]: {
-                            "1": { # "1" 固定
-                                "s_id": "44246959",
-                                "t_id": "797287",
-                                "price": "1110",
-                                "price2": "1420",
-                                "tax": 101,
-                                "tax2": 129
-                            }
-                        }
-                }
-                """
-                res_data = r.json()["tbody"]["body"]
-
-                for unit in res_data:
-                    for eigyo in res_data[unit]:
-                        # TODO:　なぜ”１”が存在する
-                        price: MultiStickerPrice = res_data[unit][eigyo]["1"]
-                        price["KAKOU"] = item["processing_opt_id"]
-                        price["KAKOU_NAME"] = item["processing_opt_name"]
-                        price["UNIT"] = unit
-                        price["SHAPE"] = "multi"
-                        price["SIZE_ID"] = item["size_id"]
-                        price["PAPER_ID"] = item["paper_id"]
-                        price["HALF_CUT"] = item["half_cut_amount_id"]
-                        price["COLOR_ID"] = item["print_color_id"]
-                        price["eigyo"] = eigyo
-                        # Override "1" object with information
-                        res_data[unit][eigyo] = price
-
-                converted_data = convert_multi_sticker_price_for_bigquery(
-                    ProductCategory.SEAL, res_data, idx
-                )
-
-                buffer += json.dumps(converted_data)[1:-1]  # ブラケットを外す
-                buffer += ","
-
-                if len(buffer.encode("utf-8")) >= chunk_size:
-                    data_to_upload = buffer
-                    buffer = None
-                    buffer = ""
-                    part_response: Any = s3_client.upload_part(
-                        file_name,
-                        part_number,
-                        upload_id,
-                        data_to_upload,
-                    )
-                    parts.append(
-                        {"PartNumber": part_number, "ETag": part_response["ETag"]}
-                    )
-                    part_number += 1
-                count += 1
-                time.sleep(interval_s)
-        except Exception as e:
-            print("Error when requesting item with info: ", item, e)
-
-    # JSONを最終化
-    if buffer:
-        if buffer[-1] == "}":
-            buffer += "}"
-        else:
-            buffer = buffer.rstrip(",") + "}"
-    part_response: Any = s3_client.upload_part(
+    return run_crawl(
+        s3_client,
         file_name,
-        part_number,
-        upload_id,
-        buffer,
+        combinations,
+        _get_price,
+        _convert_response,
+        PRINTPAC_HOST,
+        options,
+        checkpoint_store,
+        context,
+        shard,
     )
-    parts.append({"PartNumber": part_number, "ETag": part_response["ETag"]})
-    s3_client.complete_multipart_upload(file_name, upload_id, parts)
 
-    print("Success rate: {}%".format(round(count * 100 / number_of_combinations, 2)))
 
-
-def doCrawl(s3_bucketname: str, s3_subdir: str) -> bool:
+def doCrawl(
+    s3_bucketname: str,
+    s3_subdir: str,
+    options: CrawlOptions = {},
+    context: Any = None,
+    shard: Optional[ShardSpec] = None,
+    run_id: Optional[str] = None,
+) -> bool:
     try:
-        # 　ファイルの名：<相手-製品> _ <作成時間>.json
-        prefix = "printpac-multi-sticker_"
-        file_name: str = (
-            prefix + datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + ".json"
+        s3_client, file_name, checkpoint_store = prepare_crawl_output(
+            s3_bucketname, s3_subdir, FILE_PREFIX, shard, options, run_id
+        )
+        file_name = _crawl_multi_sicker_prices(
+            s3_client,
+            file_name,
+            options=options,
+            checkpoint_store=checkpoint_store,
+            plan_cache=open_plan_cache(s3_bucketname, FILE_PREFIX.rstrip("_"), options),
+            context=context,
+            shard=shard,
         )
-        s3_client = S3_Client(s3_bucketname, s3_subdir)
-        _crawl_multi_sicker_prices(s3_client, file_name)
-        print(f"Uploaded [{prefix+file_name}] successfully")
+        print(f"Uploaded [{file_name}] successfully")
         return True
+    except CrawlSuspended as e:
+        # 次の呼び出しで再開するため、呼び出し元に伝える
+        raise e
     except Exception as e:
         print("Error - ", e)
         return False
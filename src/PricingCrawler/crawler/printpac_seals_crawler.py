@@ -1,28 +1,47 @@
 # -*- coding: utf-8 -*-
-import datetime
-import math
-import requests
 from requests import Response
 import json
-from typing import Any, List, Union, Dict
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
 from bs4 import BeautifulSoup, NavigableString, Tag, ResultSet
-import time
 
-from shared.constants import SEAL_PID_TABLE, Lamination
+from shared.constants import PRINTPAC_HOST, SEAL_PID_TABLE, Lamination
 from shared.interfaces import (
+    CrawlOptions,
+    ShardSpec,
     LabelSealRequestPayload,
     OptionInfo,
+    PriceSchema,
+    SealBatchCombination,
     SealCombination,
-    SealPrice,
 )
 from aws.s3 import S3_Client
 from data_convert.convert_bigquery_format import (
     ProductCategory,
-    convert_seal_price_for_bigquery,
+    convert_price_cells_for_bigquery,
+    get_start_date,
+    seal_static_row,
 )
-from .utils import get_webpage, get_first_value_by_attr  # 用紙の種類
-
+from data_convert.price_response import (
+    PriceCell,
+    decode_seal_batch_price_response,
+    decode_seal_price_response,
+)
+from data_convert.record_batch import PriceRecordBatch
+from .utils import (
+    get_http_client,
+    get_first_value_by_attr,
+)  # 用紙の種類
+from .checkpoint import CheckpointStore, CrawlSuspended
+from .combinations import Axis, Branch, CombinationSpace, Product
+from .engine import prepare_crawl_output, run_crawl
+from .plan_cache import PlanCache, load_options, open_plan_cache
+
+# ファイルの名：<相手-製品> _ <作成時間>.json
+FILE_PREFIX: str = "printpac-label-seal_"
 tax_flag: str = "false"
+# 用紙IDをまとめたリクエストに用紙IDごとの価格表が返ってこなかった（以降は1件ずつリクエストする）
+_batch_unsupported = threading.Event()
 
 
 """
@@ -204,6 +223,14 @@ def _get_all_paper_process_options(html: BeautifulSoup) -> Dict[str, str]:
     return obj
 
 
+def _parse_options(html: BeautifulSoup) -> Dict[str, Any]:
+    return {
+        "sizes": _get_all_sizes(html),
+        "print_papers": _get_all_print_papers(html),
+        "paper_process_option": _get_all_paper_process_options(html),
+    }
+
+
 """ SECTION ENDED """
 
 
@@ -221,187 +248,224 @@ def _get_price(data) -> Response:
         "kakou": data["kakou"],
         "tax_flag": data["tax_flag"],
     }
-    response: Response = requests.post(
+    response: Response = get_http_client().post(
         url,
         headers=headers,
         data=request_payload,
     )
-    if response.ok:
-        return response
-
-    else:
+    if not response.ok:
         print("Request failed with status code:", response.status_code)
-        raise
+        # ステータスコードを含むHTTPErrorを送出する
+        response.raise_for_status()
+    return response
 
 
 def _create_all_combinations(
     sizes: List[OptionInfo],
     print_papers: List[OptionInfo],
     paper_process_option: Dict[str, str],
-) -> List[SealCombination]:
-    combinations: List[SealCombination] = []
-    for size in sizes:
-        for print_pp in print_papers:
-            possible_paper_process: List[int] = (
-                _filter_pp_process_options_by_print_paper(print_pp["id"])
-            )
-            for process in possible_paper_process:
-                # 一部の印刷用紙には異なるカスタマイズオプションがある
-                paper_id_arr = _set_paper_id_arr(print_pp["id"])
-                if paper_id_arr is None:
-                    continue
-                else:
-                    for paper_id in paper_id_arr:
-                        obj: SealCombination = {
-                            "category_id": str(_set_category_id(process)),
-                            "size_id": size["id"],
-                            "paper_arr": str(paper_id),  # paper id
-                            "kakou": str(process),
-                            "tax_flag": tax_flag,
-                            # クエリに必要な情報以外の詳細
-                            "paper_name": print_pp["name"],
-                            "paper_group_id": print_pp["id"],
-                            "shape": size["name"],
-                            "process": paper_process_option.get(str(process), "1"),
-                        }
-                        combinations.append(obj)
-
-    return combinations
+    batch_papers: bool = False,
+) -> CombinationSpace[Union[SealCombination, SealBatchCombination]]:
+    """
+    サイズ × 印刷用紙 × 加工（印刷用紙ごとに異なる） × 用紙ID（印刷用紙ごとに異なる）
+    組み合わせはリストに展開せず、インデックスから必要な時に生成する
+    batch_papers: 用紙IDだけが異なる組み合わせを1つ（SealBatchCombination）にまとめる
+    """
+
+    def _processes_of(print_pp: OptionInfo) -> Product:
+        # 一部の印刷用紙には異なるカスタマイズオプションがある
+        paper_id_arr = _set_paper_id_arr(print_pp["id"])
+        paper_ids: List[int] = paper_id_arr if paper_id_arr is not None else []
+        return Product(
+            Axis(_filter_pp_process_options_by_print_paper(print_pp["id"])),
+            Axis(
+                [[str(e) for e in paper_ids]]
+                if batch_papers and paper_ids
+                else paper_ids
+            ),
+        )
+
+    def _build(choice: Tuple[Any, ...]) -> Union[SealCombination, SealBatchCombination]:
+        size, print_pp, process, paper_id = choice
+        return {  # type: ignore
+            "category_id": str(_set_category_id(process)),
+            "size_id": size["id"],
+            # paper id（batch_papersの場合は用紙IDのリスト）
+            "paper_arr": paper_id if isinstance(paper_id, list) else str(paper_id),
+            "kakou": str(process),
+            "tax_flag": tax_flag,
+            # クエリに必要な情報以外の詳細
+            "paper_name": print_pp["name"],
+            "paper_group_id": print_pp["id"],
+            "shape": size["name"],
+            "process": paper_process_option.get(str(process), "1"),
+        }
+
+    return CombinationSpace(
+        Product(Axis(sizes), Branch(print_papers, _processes_of)), _build
+    )
+
+
+def _convert_response(
+    item: SealCombination, r: Response, idx: List[int]
+) -> PriceRecordBatch:
+    """
+    res_data: {
+        [unit] : {
+            [eigyo]: Dict[str,Union[str,int]]
+        }
+    }
+    """
+    res_data: Dict[str, Dict[str, PriceCell]] = decode_seal_price_response(r.content)
+
+    # 組み合わせで共通の列は1回だけ計算し、各セルではday/set/価格だけを埋める
+    static_row: PriceSchema = seal_static_row(
+        ProductCategory.SEAL,
+        item["shape"],
+        item["process"],
+        item["paper_group_id"],
+        item["paper_arr"],
+        get_start_date(),
+    )
+    return convert_price_cells_for_bigquery(static_row, res_data, idx)
+
+
+def _get_batched_prices(
+    data: SealBatchCombination,
+) -> Dict[str, Dict[str, Dict[str, PriceCell]]]:
+    """
+    paper_arr[]に複数の用紙IDを指定して1回でリクエストし、用紙IDごとの価格表に分ける
+    用紙IDごとの価格表が返ってこない場合は、以降のリクエストを用紙IDごとに行う
+    戻り値: {PAPER_ID: {UNIT: {EIGYO: PriceCell}}}
+    """
+    paper_ids: List[str] = data["paper_arr"]
+    if len(paper_ids) > 1 and not _batch_unsupported.is_set():
+        response: Response = _get_price(data)
+        grids: Optional[Dict[str, Dict[str, Dict[str, PriceCell]]]] = (
+            decode_seal_batch_price_response(response.content, paper_ids)
+        )
+        if grids is not None:
+            return grids
+        print("Prices were not returned per paper. Requesting one paper at a time")
+        _batch_unsupported.set()
+
+    return {
+        paper_id: decode_seal_price_response(
+            _get_price({**data, "paper_arr": paper_id}).content
+        )
+        for paper_id in paper_ids
+    }
+
+
+def _convert_batched_response(
+    item: SealBatchCombination,
+    grids: Dict[str, Dict[str, Dict[str, PriceCell]]],
+    idx: List[int],
+) -> List[PriceRecordBatch]:
+    """
+    用紙IDごとに組み合わせで共通の列（pid / oid3）が異なるため、用紙IDごとのPriceRecordBatch
+    """
+    s_date: str = get_start_date()
+    batches: List[PriceRecordBatch] = []
+    for paper_id in item["paper_arr"]:
+        static_row: PriceSchema = seal_static_row(
+            ProductCategory.SEAL,
+            item["shape"],
+            item["process"],
+            item["paper_group_id"],
+            paper_id,
+            s_date,
+        )
+        batches.append(
+            convert_price_cells_for_bigquery(static_row, grids[paper_id], idx)
+        )
+    return batches
 
 
 def _crawl_label_seal_prices(
     s3_client: S3_Client,
     file_name: str,
     save_combinations: bool = False,
-    interval_s: float = 0.1,
-) -> None:
+    options: CrawlOptions = {},
+    checkpoint_store: Optional[CheckpointStore] = None,
+    context: Any = None,
+    shard: Optional[ShardSpec] = None,
+    plan_cache: Optional[PlanCache] = None,
+) -> str:
     """
     ラベルとステッカーの価格をクロール
     save_combinations: すべての組み合わせをローカルファイルに保存するかどうか
-    interval_s:       各リクエスト間の間隔
+    options:           並行数やレート制限などのクロール設定
+    checkpoint_store:  Lambdaの時間制限で中断・再開するためのチェックポイントの保存先
+    context:           Lambdaのcontext
+    shard:             組み合わせのうち、このシャードの範囲だけをクロールする
+                       （options.batch_papersの場合は用紙IDをまとめた組み合わせで分割）
+    plan_cache:        オプションのページの解析結果のキャッシュ（ページが変わっていなければ解析しない）
     """
     url = "https://www.printpac.co.jp/contents/lineup/seal/size.php"
-    html: BeautifulSoup = get_webpage(url)
+    # ページが前回から変わっていなければ、解析せずに前回のオプションを使う
+    page_options: Dict[str, Any] = load_options(url, _parse_options, plan_cache)
 
     # 1. すべてのサイズを取得（サイズは定数）
-    sizes: List[OptionInfo] = _get_all_sizes(html)
+    sizes: List[OptionInfo] = page_options["sizes"]
 
     # 2. 印刷用紙（シールの紙質）を取得
-    print_papers: List[OptionInfo] = _get_all_print_papers(html)
-    paper_process_option: Dict[str, str] = _get_all_paper_process_options(html)
-    combinations: List[SealCombination] = _create_all_combinations(
-        sizes, print_papers, paper_process_option
+    print_papers: List[OptionInfo] = page_options["print_papers"]
+    paper_process_option: Dict[str, str] = page_options["paper_process_option"]
+    batch_papers: bool = options.get("batch_papers", False)
+    combinations: CombinationSpace[Union[SealCombination, SealBatchCombination]] = (
+        _create_all_combinations(
+            sizes, print_papers, paper_process_option, batch_papers
+        )
     )
 
     if save_combinations == True:
         with open("seal_combination.txt", "w") as file:
-            json.dump(combinations, file, indent=4, ensure_ascii=False)
+            json.dump(list(combinations), file, indent=4, ensure_ascii=False)
 
-    """
-        res_data: {
-            [unit] : {
-                [eigyo]: Dict[str,Union[str,int]]
-            }
-        }
-    """
-    count = 0
-    part_number = 1
-    chunk_size = 64 * 1024 * 1024  # 64 MB
-    parts = []
-    idx: List[int] = [0]
-
-    number_of_combinations: int = len(combinations)
-    ten_pct: int = math.ceil(number_of_combinations / 10)
-    print("[Number of Combinations] ", number_of_combinations)
-
-    upload_stream = s3_client.create_multipart_upload(file_name)
-    upload_id = upload_stream["UploadId"]
-    print(f"Multipart upload initiated with ID: {upload_id}")
-
-    # buffer.write(b"[")  # メインのJSONオブジェクトの開始
-    buffer = "{"
-
-    for item in combinations:
-        if count == number_of_combinations - 1:
-            print("Progress: 100%")
-        elif count % ten_pct == 0:
-            print("Progress: {}%".format((count * 10 / ten_pct)))
-
-        try:
-            r: Response = _get_price(item)
-            if r is None:
-                print("No data returned")
-            else:
-                res_data: Dict[str, Dict[str, SealPrice]] = r.json()["tbody"]["body"]
-
-                for unit in res_data:
-                    for eigyo in res_data[unit]:
-                        res_data[unit][eigyo]["SHAPE"] = item["shape"]
-                        res_data[unit][eigyo]["PRINT"] = item["paper_name"]
-                        res_data[unit][eigyo]["KAKOU"] = item["process"]
-                        res_data[unit][eigyo]["PAPER_GROUP_ID"] = item["paper_group_id"]
-                        res_data[unit][eigyo]["PAPER_ID"] = item["paper_arr"]
-
-                        res_data[unit][eigyo]["UNIT"] = unit
-                        res_data[unit][eigyo]["eigyo"] = eigyo
-
-                converted_data = convert_seal_price_for_bigquery(
-                    ProductCategory.SEAL, res_data, idx
-                )
-
-                buffer += json.dumps(converted_data)[1:-1]  # ブラケットを外す
-                buffer += ","
-
-                if len(buffer.encode("utf-8")) >= chunk_size:
-                    data_to_upload = buffer
-                    buffer = None
-                    buffer = ""
-                    part_response: Any = s3_client.upload_part(
-                        file_name,
-                        part_number,
-                        upload_id,
-                        data_to_upload,
-                    )
-                    parts.append(
-                        {"PartNumber": part_number, "ETag": part_response["ETag"]}
-                    )
-                    part_number += 1
-                count += 1
-                time.sleep(interval_s)
-        except Exception as e:
-            print("Error when requesting item with info: ", item, e)
-
-    # JSONを最終化
-    if buffer:
-        if buffer[-1] == "}":
-            buffer += "}"
-        else:
-            buffer = buffer.rstrip(",") + "}"
-    part_response: Any = s3_client.upload_part(
+    if batch_papers:
+        # 前回の呼び出しの結果を持ち越さず、まずはまとめてリクエストする
+        _batch_unsupported.clear()
+    return run_crawl(
+        s3_client,
         file_name,
-        part_number,
-        upload_id,
-        buffer,
+        combinations,
+        _get_batched_prices if batch_papers else _get_price,
+        _convert_batched_response if batch_papers else _convert_response,
+        PRINTPAC_HOST,
+        options,
+        checkpoint_store,
+        context,
+        shard,
     )
-    parts.append({"PartNumber": part_number, "ETag": part_response["ETag"]})
-    s3_client.complete_multipart_upload(file_name, upload_id, parts)
 
-    print(
-        "Success rate: {}%".format(round(part_number * 100 / number_of_combinations, 2))
-    )
 
-
-def doCrawl(s3_bucketname: str, s3_subdir: str) -> bool:
+def doCrawl(
+    s3_bucketname: str,
+    s3_subdir: str,
+    options: CrawlOptions = {},
+    context: Any = None,
+    shard: Optional[ShardSpec] = None,
+    run_id: Optional[str] = None,
+) -> bool:
     try:
-        # 　ファイルの名：<相手-製品> _ <作成時間>.json
-        prefix = "printpac-label-seal_"
-        file_name: str = (
-            prefix + datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + ".json"
+        s3_client, file_name, checkpoint_store = prepare_crawl_output(
+            s3_bucketname, s3_subdir, FILE_PREFIX, shard, options, run_id
+        )
+        file_name = _crawl_label_seal_prices(
+            s3_client,
+            file_name,
+            options=options,
+            checkpoint_store=checkpoint_store,
+            plan_cache=open_plan_cache(s3_bucketname, FILE_PREFIX.rstrip("_"), options),
+            context=context,
+            shard=shard,
         )
-        s3_client = S3_Client(s3_bucketname, s3_subdir)
-        _crawl_label_seal_prices(s3_client, file_name)
-        print(f"Uploaded [{prefix+file_name}] successfully")
+        print(f"Uploaded [{file_name}] successfully")
         return True
+    except CrawlSuspended as e:
+        # 次の呼び出しで再開するため、呼び出し元に伝える
+        raise e
     except Exception as e:
         print("Error - ", e)
         return False
@@ -1,23 +1,33 @@
-import time
-import datetime
-import math
 import json
-import requests
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 from requests import Response
-from bs4 import BeautifulSoup, Tag, ResultSet
 from aws.s3 import S3_Client
 
-from data_convert.convert_bigquery_format import convert_sticker_price_for_bigquery
-from shared.constants import STICKER_SIZE_TABLE, ProductCategory
+from data_convert.convert_bigquery_format import (
+    convert_price_cells_for_bigquery,
+    get_start_date,
+    sticker_static_row,
+)
+from data_convert.price_response import PriceCell, decode_sticker_price_response
+from data_convert.record_batch import PriceRecordBatch
+from shared.constants import PRINTPAC_HOST, STICKER_SIZE_TABLE, ProductCategory
 from shared.interfaces import (
+    CrawlOptions,
+    ShardSpec,
     OptionInfo,
+    PriceSchema,
     StickerSizeInfo,
     StickerCombination,
-    StickerPrice,
     StickerRequestPayload,
 )
-from .utils import get_webpage, get_first_value_by_attr
+from .utils import OPTION_INPUTS, get_http_client, group_radio_options
+from .checkpoint import CheckpointStore, CrawlSuspended
+from .combinations import Axis, Branch, CombinationSpace, Product
+from .engine import prepare_crawl_output, run_crawl
+from .plan_cache import PlanCache, load_options, open_plan_cache
+
+# ファイルの名：<相手-製品> _ <作成時間>.json
+FILE_PREFIX: str = "printpac-sticker_"
 
 
 def _extract_id(data: List[OptionInfo]) -> List[str]:
@@ -126,41 +136,20 @@ def _filter_process_opts_on_paper_material(
 """
 
 
-def _get_print_colors(html: BeautifulSoup) -> List[OptionInfo]:
-    # CMYK印刷 | RGB+α印刷
-    print_colors: List[OptionInfo] = []
-    elements: ResultSet[Tag] = html.find_all("input", type="radio")
-    for input in elements:
-        name: str = get_first_value_by_attr(input, "name")
-        if name == "print_color":
-            id: str = get_first_value_by_attr(input, "value")
-            print_colors.append({"id": id, "name": name})
-
-    return print_colors
+# options: group_radio_options()でname属性ごとにまとめたラジオボタン
 
 
-def _get_all_materials(html: BeautifulSoup) -> List[OptionInfo]:
-    materials: List[OptionInfo] = []
-    elements: ResultSet[Tag] = html.find_all("input", type="radio")
-    for input in elements:
-        name: str = get_first_value_by_attr(input, "name")
-        if name == "paper_material":
-            id: str = get_first_value_by_attr(input, "value")
-            materials.append({"id": id, "name": name})
+def _get_print_colors(options: Dict[str, List[OptionInfo]]) -> List[OptionInfo]:
+    # CMYK印刷 | RGB+α印刷
+    return options.get("print_color", [])
 
-    return materials
 
+def _get_all_materials(options: Dict[str, List[OptionInfo]]) -> List[OptionInfo]:
+    return options.get("paper_material", [])
 
-def _get_halfcut_amount(html: BeautifulSoup) -> List[OptionInfo]:
-    half_cut_amount: List[OptionInfo] = []
-    elements: ResultSet[Tag] = html.find_all("input", type="radio")
-    for input in elements:
-        name: str = get_first_value_by_attr(input, "name")
-        if name == "paper_halfcut":
-            id: str = get_first_value_by_attr(input, "value")
-            half_cut_amount.append({"id": id, "name": name})
 
-    return half_cut_amount
+def _get_halfcut_amount(options: Dict[str, List[OptionInfo]]) -> List[OptionInfo]:
+    return options.get("paper_halfcut", [])
 
 
 """ SECTION ENDED """
@@ -171,30 +160,41 @@ def _create_all_combinations(
     print_colors: List[OptionInfo],
     materials: List[OptionInfo],
     half_cut_amount: List[OptionInfo],
-) -> List[StickerCombination]:
-    combinations: List[StickerCombination] = []
-    for size in all_sizes:
-        for color_id in _extract_id(print_colors):
-            for material_id in _extract_id(materials):
-                process_opts: List[OptionInfo] = _filter_process_opts_on_paper_material(
-                    material_id
-                )
-                for process_opt in process_opts:
-                    for cut_amount_id in _extract_id(half_cut_amount):
-                        item: StickerCombination = {
-                            "size_id": all_sizes[size]["size_id"],
-                            "size_range": size,
-                            "width": all_sizes[size]["size_sample"]["width"],
-                            "height": all_sizes[size]["size_sample"]["height"],
-                            "half_cut_amount_id": cut_amount_id,
-                            "material_id": material_id,
-                            "print_color_id": color_id,
-                            "processing_opt_id": process_opt["id"],
-                            "processing_opt_name": process_opt["name"],
-                        }
-                        combinations.append(item)
-
-    return combinations
+) -> CombinationSpace[StickerCombination]:
+    """
+    サイズ × 印刷色 × 素材 × 加工（素材ごとに異なる） × ハーフカット
+    組み合わせはリストに展開せず、インデックスから必要な時に生成する
+    """
+    cut_amount_ids: List[str] = _extract_id(half_cut_amount)
+
+    def _processes_of(material_id: str) -> Product:
+        return Product(
+            Axis(_filter_process_opts_on_paper_material(material_id)),
+            Axis(cut_amount_ids),
+        )
+
+    def _build(choice: Tuple[Any, ...]) -> StickerCombination:
+        size, color_id, material_id, process_opt, cut_amount_id = choice
+        return {
+            "size_id": all_sizes[size]["size_id"],
+            "size_range": size,
+            "width": all_sizes[size]["size_sample"]["width"],
+            "height": all_sizes[size]["size_sample"]["height"],
+            "half_cut_amount_id": cut_amount_id,
+            "material_id": material_id,
+            "print_color_id": color_id,
+            "processing_opt_id": process_opt["id"],
+            "processing_opt_name": process_opt["name"],
+        }
+
+    return CombinationSpace(
+        Product(
+            Axis(list(all_sizes)),
+            Axis(_extract_id(print_colors)),
+            Branch(_extract_id(materials), _processes_of),
+        ),
+        _build,
+    )
 
 
 def _get_price(data: StickerCombination) -> Response:
@@ -214,159 +214,120 @@ def _get_price(data: StickerCombination) -> Response:
         "irokazu": "1",  # 固定
         "tax_flag": False,
     }
-    response: Response = requests.post(
+    response: Response = get_http_client().post(
         url,
         headers=headers,
         data=request_payload,
     )
-    if response.ok:
-        return response
-
-    else:
+    if not response.ok:
         print("Request failed with status code:", response.status_code)
-        raise
+        # ステータスコードを含むHTTPErrorを送出する
+        response.raise_for_status()
+    return response
+
+
+def _convert_response(
+    item: StickerCombination, r: Response, idx: List[int]
+) -> PriceRecordBatch:
+    """
+    response: {
+        [UNIT]: {
+            [EIGYO]: {
+                "1": { # "1" 固定
+                    "s_id": "44246959",
+                    "t_id": "797287",
+                    "price": "1110",
+                    "price2": "1420",
+                    "tax": 101,
+                    "tax2": 129
+                }
+            }
+    }
+    """
+    # 価格のセルは固定のキー"1"の下にあるため、デコード時に"1"を外した価格表にする
+    res_data: Dict[str, Dict[str, PriceCell]] = decode_sticker_price_response(r.content)
+
+    # 組み合わせで共通の列は1回だけ計算し、各セルではday/set/価格だけを埋める
+    static_row: PriceSchema = sticker_static_row(
+        ProductCategory.STICKER,
+        "自由",
+        item["processing_opt_name"],
+        item["material_id"],
+        item["size_range"],
+        item["print_color_id"],
+        item["half_cut_amount_id"],
+        get_start_date(),
+    )
+    return convert_price_cells_for_bigquery(static_row, res_data, idx)
 
 
 def _crawl_sicker_prices(
     s3_client: S3_Client,
     file_name: str,
     save_combinations: bool = False,
-    interval_s: float = 0.1,
-) -> None:
+    options: CrawlOptions = {},
+    checkpoint_store: Optional[CheckpointStore] = None,
+    context: Any = None,
+    shard: Optional[ShardSpec] = None,
+    plan_cache: Optional[PlanCache] = None,
+) -> str:
     url = "https://www.printpac.co.jp/contents/lineup/sticker/"
-    html: BeautifulSoup = get_webpage(url)
+    # ページが前回から変わっていなければ、解析せずに前回のオプションを使う
+    options_by_name: Dict[str, List[OptionInfo]] = load_options(
+        url, group_radio_options, plan_cache, parse_only=OPTION_INPUTS
+    )
 
-    combinations: List[StickerCombination] = _create_all_combinations(
+    combinations: CombinationSpace[StickerCombination] = _create_all_combinations(
         all_sizes=STICKER_SIZE_TABLE,
-        half_cut_amount=_get_halfcut_amount(html),
-        materials=_get_all_materials(html),
-        print_colors=_get_print_colors(html),
+        half_cut_amount=_get_halfcut_amount(options_by_name),
+        materials=_get_all_materials(options_by_name),
+        print_colors=_get_print_colors(options_by_name),
     )
 
     if save_combinations == True:
         with open("sticker_combination.txt", "w") as file:
-            json.dump(combinations, file, indent=4, ensure_ascii=False)
+            json.dump(list(combinations), file, indent=4, ensure_ascii=False)
 
-    """
-        res_data: {
-            [unit] : {
-                [eigyo]: Dict[str,Union[str,int]]
-            }
-        }
-    """
-    count: int = 0
-    part_number = 1
-    chunk_size = 64 * 1024 * 1024  # 64 MB
-    parts = []
-    idx: List[int] = [0]
-
-    number_of_combinations: int = len(combinations)
-    ten_pct: int = math.ceil(number_of_combinations / 10)
-    print("[Number of Combinations] ", number_of_combinations)
-
-    upload_stream = s3_client.create_multipart_upload(file_name)
-    upload_id = upload_stream["UploadId"]
-    print(f"Multipart upload initiated with ID: {upload_id}")
-
-    buffer = "{"
-    for item in combinations:
-        if count == (number_of_combinations - 1):
-            print("Progress: 100%")
-        elif count % ten_pct == 0:
-            print("Progress: {}%".format((count * 10 / ten_pct)))
-
-        try:
-            r: Response = _get_price(item)
-            if r is None:
-                print("No data returned")
-            else:
-                """
-                response: {
-                    [UNIT]: {
-                        [EIGYO]: {
-                            "1": { # "1" 固定
-                                "s_id": "44246959",
-                                "t_id": "797287",
-                                "price": "1110",
-                                "price2": "1420",
-                                "tax": 101,
-                                "tax2": 129
-                            }
-                        }
-                }
-                """
-                res_data = r.json()["tbody"]["body"]
-
-                for unit in res_data:
-                    for eigyo in res_data[unit]:
-                        # TODO:　なぜ”１”が存在する
-                        price: StickerPrice = res_data[unit][eigyo]["1"]
-                        price["KAKOU"] = item["processing_opt_id"]
-                        price["KAKOU_NAME"] = item["processing_opt_name"]
-                        price["UNIT"] = unit
-                        price["SHAPE"] = "自由"
-                        price["SIZE_RANGE"] = item["size_range"]
-                        price["MATERIAL_ID"] = item["material_id"]
-                        price["HALF_CUT"] = item["half_cut_amount_id"]
-                        price["COLOR_ID"] = item["print_color_id"]
-                        price["eigyo"] = eigyo
-                        # Override "1" object with information
-                        res_data[unit][eigyo] = price
-                converted_data = convert_sticker_price_for_bigquery(
-                    ProductCategory.STICKER, res_data, idx
-                )
-
-                buffer += json.dumps(converted_data)[1:-1]  # ブラケットを外す
-                buffer += ","
-
-                if len(buffer.encode("utf-8")) >= chunk_size:
-                    data_to_upload = buffer
-                    buffer = None
-                    buffer = ""
-                    part_response: Any = s3_client.upload_part(
-                        file_name,
-                        part_number,
-                        upload_id,
-                        data_to_upload,
-                    )
-                    parts.append(
-                        {"PartNumber": part_number, "ETag": part_response["ETag"]}
-                    )
-                    part_number += 1
-                count += 1
-                time.sleep(interval_s)
-        except Exception as e:
-            print("Error when requesting item with info: ", item, e)
-
-    # JSONを最終化
-    if buffer:
-        if buffer[-1] == "}":
-            buffer += "}"
-        else:
-            buffer = buffer.rstrip(",") + "}"
-    part_response: Any = s3_client.upload_part(
+    return run_crawl(
+        s3_client,
         file_name,
-        part_number,
-        upload_id,
-        buffer,
+        combinations,
+        _get_price,
+        _convert_response,
+        PRINTPAC_HOST,
+        options,
+        checkpoint_store,
+        context,
+        shard,
     )
-    parts.append({"PartNumber": part_number, "ETag": part_response["ETag"]})
-    s3_client.complete_multipart_upload(file_name, upload_id, parts)
-
-    print("Success rate: {}%".format(round(count * 100 / number_of_combinations, 2)))
 
 
-def doCrawl(s3_bucketname: str, s3_subdir: str) -> bool:
+def doCrawl(
+    s3_bucketname: str,
+    s3_subdir: str,
+    options: CrawlOptions = {},
+    context: Any = None,
+    shard: Optional[ShardSpec] = None,
+    run_id: Optional[str] = None,
+) -> bool:
     try:
-        # 　ファイルの名：<相手-製品> _ <作成時間>.json
-        prefix = "printpac-sticker_"
-        file_name: str = (
-            prefix + datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + ".json"
+        s3_client, file_name, checkpoint_store = prepare_crawl_output(
+            s3_bucketname, s3_subdir, FILE_PREFIX, shard, options, run_id
+        )
+        file_name = _crawl_sicker_prices(
+            s3_client,
+            file_name,
+            options=options,
+            checkpoint_store=checkpoint_store,
+            plan_cache=open_plan_cache(s3_bucketname, FILE_PREFIX.rstrip("_"), options),
+            context=context,
+            shard=shard,
         )
-        s3_client = S3_Client(s3_bucketname, s3_subdir)
-        _crawl_sicker_prices(s3_client, file_name)
         print(f"Uploaded [{file_name}] successfully")
         return True
+    except CrawlSuspended as e:
+        # 次の呼び出しで再開するため、呼び出し元に伝える
+        raise e
     except Exception as e:
         print("Error - ", e)
         return False
@@ -0,0 +1,268 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_RATE_PER_S: float = 8.0  # 1秒あたりのリクエスト数
+DEFAULT_BURST: int = 8  # 連続して送信できるリクエスト数
+DEFAULT_MAX_CONCURRENCY: int = 8  # ホストへの同時接続数の上限
+
+# 適応制御（AIMD）の既定値
+DEFAULT_MIN_RATE_PER_S: float = 1.0  # 減速時の下限
+DEFAULT_MAX_RATE_PER_S: float = 20.0  # 加速時の上限
+DEFAULT_RATE_STEP_PER_S: float = 1.0  # 安定している区間ごとに加算するリクエスト数
+DEFAULT_DECREASE_FACTOR: float = 0.5  # エラーや遅延の急増時に掛ける係数
+DEFAULT_LATENCY_WINDOW: int = 50  # p50/p95を計算するレスポンス数
+DEFAULT_LATENCY_SPIKE_FACTOR: float = (
+    3.0  # 基準のp50に対してp95がこの倍率を超えたら急増とみなす
+)
+BACKOFF_STATUS_CODES: Tuple[int, ...] = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    トークンバケット
+    rate_per_sの速度でトークンが補充され、最大burst個まで貯められます
+    1リクエストにつき1トークンを消費し、トークンがない場合は補充されるまで待ちます
+    """
+
+    rate_per_s: float
+    burst: int
+
+    def __init__(self, rate_per_s: float, burst: int) -> None:
+        if rate_per_s <= 0:
+            raise ValueError("rate_per_s must be positive")
+        self.rate_per_s = rate_per_s
+        self.burst = max(1, burst)
+        self._tokens: float = float(self.burst)
+        self._updated: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate_per_s: float) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate_per_s = rate_per_s
+
+    def _refill(self, now: float) -> None:
+        elapsed: float = now - self._updated
+        self._tokens = min(float(self.burst), self._tokens + elapsed * self.rate_per_s)
+        self._updated = now
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_s: float = (1 - self._tokens) / self.rate_per_s
+            time.sleep(wait_s)
+
+
+class ConcurrencyLimit:
+    """
+    上限を実行中に変更できるセマフォ
+    上限を下げた場合、実行中のリクエストが終わるまで新しいリクエストは待たされます
+    """
+
+    limit: int
+
+    def __init__(self, limit: int) -> None:
+        self.limit = max(1, limit)
+        self._active: int = 0
+        self._cond = threading.Condition()
+
+    def set_limit(self, limit: int) -> None:
+        with self._cond:
+            self.limit = max(1, limit)
+            self._cond.notify_all()
+
+    def __enter__(self) -> "ConcurrencyLimit":
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+        return self
+
+    def __exit__(self, *args) -> None:
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    k: int = min(len(sorted_values) - 1, int(round(pct * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+class AdaptiveRateController:
+    """
+    AIMD（加算増加・乗算減少）によるリクエストレートの適応制御
+    - レスポンスのp50/p95が安定している間は、区間ごとにレートと同時接続数を少しずつ上げる
+    - 429/5xx、タイムアウト、接続エラー、遅延の急増があった場合は乗算的に下げる
+    """
+
+    min_rate_per_s: float
+    max_rate_per_s: float
+    max_concurrency: int
+
+    def __init__(
+        self,
+        bucket: TokenBucket,
+        slots: ConcurrencyLimit,
+        max_concurrency: int,
+        min_rate_per_s: float = DEFAULT_MIN_RATE_PER_S,
+        max_rate_per_s: float = DEFAULT_MAX_RATE_PER_S,
+        rate_step_per_s: float = DEFAULT_RATE_STEP_PER_S,
+        decrease_factor: float = DEFAULT_DECREASE_FACTOR,
+        latency_window: int = DEFAULT_LATENCY_WINDOW,
+        latency_spike_factor: float = DEFAULT_LATENCY_SPIKE_FACTOR,
+    ) -> None:
+        self.bucket = bucket
+        self.slots = slots
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_rate_per_s = min_rate_per_s
+        self.max_rate_per_s = max(min_rate_per_s, max_rate_per_s)
+        self.rate_step_per_s = rate_step_per_s
+        self.decrease_factor = decrease_factor
+        self.latency_window = max(1, latency_window)
+        self.latency_spike_factor = latency_spike_factor
+
+        self._latencies: Deque[float] = deque()
+        self._baseline_p50: Optional[float] = None
+        # 減速した直後に送信済みのリクエストのエラーで連続して減速しないように、次の区間まで待つ
+        self._decreased_at: float = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, latency_s: float, status_code: Optional[int]) -> None:
+        """
+        1リクエストの結果を記録する
+        status_code: レスポンスのステータスコード（タイムアウトや接続エラーの場合はNone）
+        """
+        with self._lock:
+            if status_code is None or status_code in BACKOFF_STATUS_CODES:
+                self._decrease("status={}".format(status_code))
+                return
+
+            self._latencies.append(latency_s)
+            if len(self._latencies) < self.latency_window:
+                return
+
+            latencies: List[float] = sorted(self._latencies)
+            self._latencies.clear()
+            p50: float = _percentile(latencies, 0.5)
+            p95: float = _percentile(latencies, 0.95)
+
+            if self._baseline_p50 is None:
+                self._baseline_p50 = p50
+            if p95 > self._baseline_p50 * self.latency_spike_factor:
+                self._decrease("p50={:.3f}s p95={:.3f}s".format(p50, p95))
+                return
+
+            # 安定している区間のp50で基準を更新する（指数移動平均）
+            self._baseline_p50 = 0.8 * self._baseline_p50 + 0.2 * p50
+            self._increase()
+
+    def _increase(self) -> None:
+        rate: float = min(
+            self.max_rate_per_s, self.bucket.rate_per_s + self.rate_step_per_s
+        )
+        limit: int = min(self.max_concurrency, self.slots.limit + 1)
+        if rate != self.bucket.rate_per_s or limit != self.slots.limit:
+            self.bucket.set_rate(rate)
+            self.slots.set_limit(limit)
+
+    def _decrease(self, reason: str) -> None:
+        now: float = time.monotonic()
+        # 現在のレートで1区間分のリクエストを送る前の再減速は行わない
+        if now - self._decreased_at < self.latency_window / self.bucket.rate_per_s:
+            return
+        self._decreased_at = now
+        self._latencies.clear()
+
+        rate: float = max(
+            self.min_rate_per_s, self.bucket.rate_per_s * self.decrease_factor
+        )
+        limit: int = max(1, int(self.slots.limit * self.decrease_factor))
+        self.bucket.set_rate(rate)
+        self.slots.set_limit(limit)
+        print(
+            "[RateLimit] Back off ({}): rate={:.1f}/s, concurrency={}".format(
+                reason, rate, limit
+            )
+        )
+
+
+class HostRateLimiter:
+    """
+    ホストごとのレート制限
+    トークンバケットによる秒間リクエスト数と、同時接続数の両方を制限します
+    adaptive=Trueの場合、レスポンスに応じてAdaptiveRateControllerがレートと同時接続数を調整します
+    """
+
+    bucket: TokenBucket
+    max_concurrency: int
+    controller: Optional[AdaptiveRateController]
+
+    def __init__(
+        self,
+        rate_per_s: float = DEFAULT_RATE_PER_S,
+        burst: int = DEFAULT_BURST,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        adaptive: bool = False,
+        min_rate_per_s: float = DEFAULT_MIN_RATE_PER_S,
+        max_rate_per_s: float = DEFAULT_MAX_RATE_PER_S,
+    ) -> None:
+        self.bucket = TokenBucket(rate_per_s, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.controller = None
+        if adaptive:
+            # 同時接続数を上げる余地を残すため、上限の半分から始める
+            self._slots = ConcurrencyLimit(max(1, self.max_concurrency // 2))
+            self.controller = AdaptiveRateController(
+                self.bucket,
+                self._slots,
+                self.max_concurrency,
+                min_rate_per_s=min_rate_per_s,
+                max_rate_per_s=max_rate_per_s,
+            )
+        else:
+            self._slots = ConcurrencyLimit(self.max_concurrency)
+
+    def record(self, latency_s: float, status_code: Optional[int]) -> None:
+        if self.controller is not None:
+            self.controller.record(latency_s, status_code)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """
+        同時接続の枠とトークンを取得してからリクエストを送信する
+        例:
+            with limiter.slot():
+                session.request(...)
+        """
+        with self._slots:
+            self.bucket.acquire()
+            yield
+
+
+_host_limiters: Dict[str, HostRateLimiter] = {}
+_host_limiters_lock = threading.Lock()
+
+
+def configure_host_limit(host: str, **kwargs) -> HostRateLimiter:
+    """
+    ホストのレート制限を設定する（既存の設定は置き換えられます）
+    kwargs: HostRateLimiterの引数
+    """
+    limiter = HostRateLimiter(**kwargs)
+    with _host_limiters_lock:
+        _host_limiters[host] = limiter
+    return limiter
+
+
+def get_host_limiter(host: Optional[str]) -> Optional[HostRateLimiter]:
+    if host is None:
+        return None
+    return _host_limiters.get(host)
@@ -0,0 +1,91 @@
+import random
+import time
+from typing import Callable, Optional, Tuple, TypeVar
+
+import requests
+
+R = TypeVar("R")
+
+DEFAULT_MAX_ATTEMPTS: int = 4  # 最初のリクエストを含めた試行回数
+DEFAULT_BASE_DELAY_S: float = 0.5  # 1回目の再試行までの待ち時間の上限
+DEFAULT_MAX_DELAY_S: float = 20.0  # 再試行までの待ち時間の上限
+RETRYABLE_STATUS_CODES: Tuple[int, ...] = (408, 429, 500, 502, 503, 504)
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code
+    return None
+
+
+class RetryPolicy:
+    """
+    指数バックオフとジッター（Full Jitter）による再試行
+    - タイムアウト、接続エラー、RETRYABLE_STATUS_CODESのHTTPErrorのみ再試行します
+    - 429/503でRetry-Afterヘッダーがある場合は、その秒数を優先します
+    """
+
+    max_attempts: int
+    base_delay_s: float
+    max_delay_s: float
+
+    def __init__(
+        self,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        base_delay_s: float = DEFAULT_BASE_DELAY_S,
+        max_delay_s: float = DEFAULT_MAX_DELAY_S,
+    ) -> None:
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(
+            error,
+            (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ),
+        ):
+            return True
+        return _status_code(error) in RETRYABLE_STATUS_CODES
+
+    def backoff_s(self, attempt: int, error: Optional[Exception] = None) -> float:
+        """
+        attempt回目（1始まり）の失敗後に待つ秒数
+        """
+        if (
+            isinstance(error, requests.exceptions.HTTPError)
+            and error.response is not None
+        ):
+            retry_after: Optional[str] = error.response.headers.get("Retry-After")
+            if retry_after is not None and retry_after.isdigit():
+                return min(self.max_delay_s, float(retry_after))
+
+        ceiling: float = min(self.max_delay_s, self.base_delay_s * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def call(
+        self,
+        func: Callable[..., R],
+        *args,
+        should_stop: Callable[[], bool] = lambda: False,
+    ) -> R:
+        """
+        should_stop: Trueを返した場合は再試行せずに最後のエラーを送出する
+                     （Lambdaの残り時間が少ない場合に、中断までの時間を1回のリクエスト分に抑える）
+        """
+        attempt: int = 1
+        while True:
+            try:
+                return func(*args)
+            except Exception as e:
+                if (
+                    attempt >= self.max_attempts
+                    or not self.is_retryable(e)
+                    or should_stop()
+                ):
+                    raise
+                time.sleep(self.backoff_s(attempt, e))
+                attempt += 1
@@ -0,0 +1,279 @@
+import datetime
+import json
+import time
+from typing import List, Tuple
+
+from botocore.exceptions import ClientError
+
+from aws.s3 import MultipartWriter, S3_Client
+from shared.interfaces import CrawlOptions, ShardSpec
+from .output_format import (
+    OutputFormat,
+    failed_file_name,
+    get_output_format,
+    output_extension,
+)
+
+# シャードの出力先（PricingRegisterのS3トリガーの対象外のプレフィックス）
+SHARD_SUBDIR_PATH = "shards/"
+# シャードごとのレコード番号の開始位置の間隔（結合後もレコード番号が重複しないように）
+SHARD_INDEX_STRIDE: int = 1000 * 1000 * 1000
+MERGE_CHUNK_SIZE: int = 64 * 1024 * 1024  # 64 MB
+READ_CHUNK_SIZE: int = 1024 * 1024  # 1 MB
+# 結合を行う呼び出しを1つに決めるためのマーカー（シャードのディレクトリに作成する）
+MERGE_MARKER_FILE_NAME = "merge.lock"
+# マーカーの期限（結合を行う呼び出しの残り時間がわからない場合。Lambdaの実行時間の上限）
+# 結合中の呼び出しがタイムアウトやメモリ不足で終了した場合、期限が過ぎたら他の呼び出しが引き継ぐ
+MERGE_LEASE_S: float = 15 * 60
+# クロールが失敗したシャードの印（シャードを再実行して.partができるまで結合しない）
+INCOMPLETE_SUFFIX = ".incomplete"
+
+
+def shard_range(number_of_combinations: int, shard: ShardSpec) -> Tuple[int, int]:
+    """
+    組み合わせをshard_count個の連続した範囲に分割し、shard_index番目の範囲[start, end)を返す
+    """
+    start: int = number_of_combinations * shard["shard_index"] // shard["shard_count"]
+    end: int = (
+        number_of_combinations * (shard["shard_index"] + 1) // shard["shard_count"]
+    )
+    return start, end
+
+
+def shard_dir(prefix: str, run_id: str) -> str:
+    """
+    例: printpac-label-seal_2024-06-23-00-22-25/
+    """
+    return prefix + run_id + "/"
+
+
+def _shard_base_name(prefix: str, shard: ShardSpec) -> str:
+    return shard_dir(prefix, shard["run_id"]) + "shard-{:04d}-of-{:04d}".format(
+        shard["shard_index"], shard["shard_count"]
+    )
+
+
+def shard_file_name(prefix: str, shard: ShardSpec) -> str:
+    """
+    例: printpac-label-seal_2024-06-23-00-22-25/shard-0003-of-0008.part
+    """
+    return _shard_base_name(prefix, shard) + ".part"
+
+
+def _shard_index(key: str) -> int:
+    """
+    例: .../shard-0003-of-0008.part -> 3
+    """
+    return int(key.split("/")[-1].split("-")[1])
+
+
+def merged_file_name(prefix: str, run_id: str, options: CrawlOptions = {}) -> str:
+    """
+    例: printpac-label-seal_2024-06-23-00-22-25.json（NDJSON+zstdの場合は.ndjson.zst）
+    """
+    return (
+        prefix
+        + run_id
+        + output_extension(options.get("output_format"), options.get("compression"))
+    )
+
+
+def _list_shard_keys(
+    s3_client: S3_Client, prefix: str, run_id: str, suffix: str = ".part"
+) -> List[str]:
+    """
+    suffix: ".part"（シャードの出力） | "_failed.jsonl"（シャードの失敗した組み合わせ）
+            | INCOMPLETE_SUFFIX（クロールが失敗したシャード）
+    """
+    keys: List[str] = []
+    paginator = s3_client.s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=s3_client.bucket_name,
+        Prefix=s3_client.subdir + shard_dir(prefix, run_id),
+    ):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(suffix):
+                keys.append(obj["Key"][len(s3_client.subdir) :])
+    return sorted(keys)
+
+
+def _merge_failed_combinations(
+    shard_client: S3_Client,
+    s3_client: S3_Client,
+    prefix: str,
+    run_id: str,
+    file_name: str,
+) -> None:
+    """
+    シャードごとの失敗した組み合わせ（_failed.jsonl）を結合後のファイルと同じ場所の
+    <ファイル名>_failed.jsonlにまとめ、シャードのものは削除する
+    """
+    failed_keys: List[str] = _list_shard_keys(
+        shard_client, prefix, run_id, "_failed.jsonl"
+    )
+    if not failed_keys:
+        return
+
+    body: bytes = b"".join(
+        shard_client.get_object(key)["Body"].read() for key in failed_keys
+    )
+    s3_client.put_object(failed_file_name(file_name), body)
+    for key in failed_keys:
+        shard_client.delete_object(key)
+    print(
+        f"Merged failed combinations of [{len(failed_keys)}] shards into "
+        f"[{failed_file_name(file_name)}]"
+    )
+
+
+def mark_shard_incomplete(
+    s3_bucketname: str, prefix: str, shard: ShardSpec, reason: str
+) -> None:
+    """
+    シャードのクロールが失敗したことを記録する（shard_statusで未完了のシャードとして報告される）
+    """
+    S3_Client(s3_bucketname, SHARD_SUBDIR_PATH).put_object(
+        _shard_base_name(prefix, shard) + INCOMPLETE_SUFFIX, reason
+    )
+
+
+def shard_status(
+    s3_bucketname: str, prefix: str, run_id: str
+) -> Tuple[List[int], List[int]]:
+    """
+    戻り値: (出力が揃ったシャード番号, クロールが失敗したシャード番号)
+    失敗した後に再実行して出力が揃ったシャードは、出力が揃ったシャードとして数える
+    """
+    shard_client = S3_Client(s3_bucketname, SHARD_SUBDIR_PATH)
+    completed: List[int] = [
+        _shard_index(key) for key in _list_shard_keys(shard_client, prefix, run_id)
+    ]
+    incomplete: List[int] = [
+        _shard_index(key)
+        for key in _list_shard_keys(shard_client, prefix, run_id, INCOMPLETE_SUFFIX)
+        if _shard_index(key) not in completed
+    ]
+    return completed, incomplete
+
+
+def _lease_body(run_id: str, lease_s: float) -> str:
+    # 期限を含むため、引き継ぐたびに内容（ETag）が変わる
+    return json.dumps({"run_id": run_id, "expires_at": time.time() + lease_s})
+
+
+def _claim_merge(
+    shard_client: S3_Client, marker: str, run_id: str, lease_s: float
+) -> bool:
+    """
+    マーカーを作成、または期限切れのマーカーを引き継ぎ、結合を行う呼び出しを1つに決める
+    戻り値: この呼び出しが結合を行う場合True
+    """
+    if shard_client.put_object_if_absent(marker, _lease_body(run_id, lease_s)):
+        return True
+    try:
+        current = shard_client.get_object(marker)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise e
+        # 結合に失敗した呼び出しがマーカーを削除した
+        return shard_client.put_object_if_absent(marker, _lease_body(run_id, lease_s))
+    try:
+        expires_at: float = float(json.loads(current["Body"].read())["expires_at"])
+    except (ValueError, KeyError, TypeError):
+        expires_at = 0.0  # 期限のないマーカーは引き継ぐ
+    if time.time() < expires_at:
+        print(
+            f"[{marker}] is held by another invocation until "
+            f"[{datetime.datetime.fromtimestamp(expires_at).isoformat()}]. Skip."
+        )
+        return False
+    # 読んだ後に他の呼び出しが引き継いでいない（ETagが変わっていない）場合だけ引き継ぐ
+    if not shard_client.put_object_if_match(
+        marker, _lease_body(run_id, lease_s), current["ETag"]
+    ):
+        print(f"[{marker}] has been taken over by another invocation. Skip.")
+        return False
+    print(f"Took over the expired merge lock [{marker}]")
+    return True
+
+
+def merge_shards(
+    s3_bucketname: str,
+    s3_subdir: str,
+    prefix: str,
+    run_id: str,
+    shard_count: int,
+    options: CrawlOptions = {},
+    lease_s: float = MERGE_LEASE_S,
+) -> str:
+    """
+    シャードの出力（波括弧なしのJSONの断片、またはNDJSONの行）を順番につなげ、
+    PricingRegisterが読み込む1つのファイルとしてs3_subdirにアップロードする
+    options: シャードと同じクロール設定（出力形式と圧縮形式）
+             圧縮されたシャードは展開せずに連結し、波括弧と区切りだけを
+             別のgzipメンバー/zstdフレームとして書き込みます
+    lease_s: マーカーの期限（この呼び出しの残り時間）
+    戻り値: アップロードしたファイル名
+    """
+    shard_client = S3_Client(s3_bucketname, SHARD_SUBDIR_PATH)
+    s3_client = S3_Client(s3_bucketname, s3_subdir)
+    file_name: str = merged_file_name(prefix, run_id, options)
+    output_format: OutputFormat = get_output_format(options.get("output_format"))
+
+    shard_keys: List[str] = _list_shard_keys(shard_client, prefix, run_id)
+    if len(shard_keys) != shard_count:
+        missing: List[int] = sorted(
+            set(range(shard_count)) - {_shard_index(key) for key in shard_keys}
+        )
+        raise ValueError(f"Shards {missing} of [{file_name}] have not completed")
+    if s3_client.exists(file_name):
+        print(f"[{file_name}] has already been merged. Skip.")
+        return file_name
+    # 複数のシャードから同時にマージが呼ばれた場合は、マーカーを作成できた1回だけを行う
+    # （結合後のファイルが2回アップロードされ、PricingRegisterが2回呼ばれないように）
+    marker: str = shard_dir(prefix, run_id) + MERGE_MARKER_FILE_NAME
+    if not _claim_merge(shard_client, marker, run_id, lease_s):
+        return file_name
+    # 異常終了した結合のアップロードが残っている場合は中止する
+    for upload_id in s3_client.list_multipart_uploads(file_name):
+        s3_client.abort_multipart_upload(file_name, upload_id)
+        print(f"Aborted the multipart upload [{upload_id}] of an earlier merge")
+
+    writer = MultipartWriter(
+        s3_client,
+        file_name,
+        part_size=MERGE_CHUNK_SIZE,
+        compression=options.get("compression"),
+    )
+    has_records: bool = False
+    try:
+        writer.write(output_format.header)
+        for key in shard_keys:
+            body = shard_client.get_object(key)["Body"]
+            first_chunk: bool = True
+            for chunk in body.iter_chunks(READ_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                # 前のシャードとの区切り
+                if first_chunk and has_records:
+                    writer.write(output_format.separator)
+                first_chunk = False
+                has_records = True
+                writer.write_raw(chunk)
+
+        writer.write(output_format.footer)
+        writer.close()
+    except Exception as e:
+        writer.abort()
+        # 次の呼び出しで結合をやり直せるようにする
+        shard_client.delete_object(marker)
+        raise e
+
+    _merge_failed_combinations(shard_client, s3_client, prefix, run_id, file_name)
+    # マーカーは残す（後から呼ばれた結合をスキップするため）
+    for key in shard_keys + _list_shard_keys(
+        shard_client, prefix, run_id, INCOMPLETE_SUFFIX
+    ):
+        shard_client.delete_object(key)
+    print(f"Merged [{len(shard_keys)}] shards into [{file_name}]")
+    return file_name
@@ -1,20 +1,128 @@
+import threading
+import time
 import requests
+from urllib.parse import urlparse
 from requests import Response
-from bs4 import BeautifulSoup, Tag
-from typing import List, Union
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+from typing import Dict, List, Optional, Tuple, Union
 
 from shared.interfaces import OptionInfo
+from .rate_limit import HostRateLimiter, get_host_limiter
 
+# すべてのクローラーで共有するHTTP接続の既定値
+DEFAULT_HEADERS: Dict[str, str] = {
+    "User-Agent": "Mozilla/5.0 (compatible; PricingCrawler/1.0)",
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+}
+DEFAULT_TIMEOUT_S: Tuple[float, float] = (5.0, 30.0)  # (接続, 読み込み)
+DEFAULT_POOL_CONNECTIONS: int = 4  # 接続プールを保持するホスト数
+DEFAULT_POOL_MAXSIZE: int = 16  # ホストごとに保持するkeep-alive接続数
+HTML_PARSER: str = "lxml"  # html.parser（pure Python）より高速
+# オプションのページから<input>だけを解析する（ステッカーのオプションはすべてラジオボタン）
+OPTION_INPUTS: SoupStrainer = SoupStrainer("input")
 
-def get_webpage(url: str) -> BeautifulSoup:
-    try:
-        response: Response = requests.get(url)
-        response.raise_for_status()
-        soup: BeautifulSoup = BeautifulSoup(response.content, "html.parser")
-        return soup
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        raise e
+
+class HttpClient:
+    """
+    keep-aliveの接続プールを持つHTTPクライアント
+    リクエストごとのTCP+TLSハンドシェイクを避けるため、Sessionを使い回します
+    """
+
+    session: requests.Session
+    timeout: Tuple[float, float]
+    pool_maxsize: int
+
+    def __init__(
+        self,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Tuple[float, float] = DEFAULT_TIMEOUT_S,
+        pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+        pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+    ) -> None:
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        if headers:
+            self.session.headers.update(headers)
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=True,  # プールが満杯の場合は接続を作らずに待つ
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> Response:
+        """
+        送信先ホストにレート制限が設定されている場合は、制限内で送信し、
+        レイテンシとステータスコードをレート制限に記録する
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        limiter: Optional[HostRateLimiter] = get_host_limiter(urlparse(url).hostname)
+        if limiter is None:
+            return self.session.request(method, url, **kwargs)
+
+        with limiter.slot():
+            started: float = time.monotonic()
+            try:
+                response: Response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                limiter.record(time.monotonic() - started, None)
+                raise
+            limiter.record(time.monotonic() - started, response.status_code)
+            return response
+
+    def get(self, url: str, **kwargs) -> Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_http_client: Optional[HttpClient] = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> HttpClient:
+    """
+    プロセス内で共有するHttpClientを返す
+    Lambdaのウォームスタート時には前回の接続プールがそのまま使われます
+    """
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = HttpClient()
+    return _http_client
+
+
+def configure_http_client(**kwargs) -> HttpClient:
+    """
+    共有HttpClientを指定した設定で作り直す
+    kwargs: HttpClientの引数（headers, timeout, pool_connections, pool_maxsize）
+    """
+    global _http_client
+    with _http_client_lock:
+        if _http_client is not None:
+            _http_client.close()
+        _http_client = HttpClient(**kwargs)
+    return _http_client
+
+
+def parse_webpage(
+    content: bytes, parse_only: Optional[SoupStrainer] = None
+) -> BeautifulSoup:
+    """
+    parse_only: 指定された場合、一致する要素だけを解析する（例: OPTION_INPUTS）
+    """
+    return BeautifulSoup(content, HTML_PARSER, parse_only=parse_only)
 
 
 def get_first_value_by_attr(el: Tag, field: str) -> str:
@@ -32,5 +140,35 @@ def get_first_value_by_attr(el: Tag, field: str) -> str:
         raise ValueError("Invalid input")
 
 
+def group_inputs_by_name(
+    html: BeautifulSoup, input_type: Optional[str] = "radio"
+) -> Dict[str, List[Tag]]:
+    """
+    1回の走査で<input>をname属性ごとにまとめる
+    input_type: 指定された場合、このtypeの<input>だけ（Noneの場合はすべて）
+    """
+    groups: Dict[str, List[Tag]] = {}
+    for el in html.find_all("input"):
+        if input_type is not None and el.get("type") != input_type:
+            continue
+        if el.get("name") is None:
+            continue
+        groups.setdefault(get_first_value_by_attr(el, "name"), []).append(el)
+    return groups
+
+
+def group_radio_options(html: BeautifulSoup) -> Dict[str, List[OptionInfo]]:
+    """
+    ラジオボタンをname属性ごとにOptionInfoのリストにする
+    結果の例: {"print_color": [{"id": "1", "name": "print_color"}, ...], ...}
+    """
+    return {
+        name: [
+            {"id": get_first_value_by_attr(el, "value"), "name": name} for el in inputs
+        ]
+        for name, inputs in group_inputs_by_name(html).items()
+    }
+
+
 def extract_id(data: List[OptionInfo]) -> List[str]:
     return [e["id"] for e in data]
@@ -1,5 +1,7 @@
-from typing import Match, Union, Dict
+from typing import Any, List, Match, Tuple, Union, Dict
+from array import array
 import datetime
+import functools
 import re
 from shared.constants import (
     MULTI_STICKER_PID_TABLE,
@@ -12,7 +14,9 @@ from shared.constants import (
     ProductCategory,
     SEAL_PID_TABLE,
 )
-from shared.interfaces import MultiStickerPrice, PriceSchema, SealPrice, StickerPrice
+from shared.interfaces import PriceSchema
+from .price_response import PriceCell
+from .record_batch import PriceRecordBatch
 
 
 yid_fixed = 21  # 固定
@@ -175,176 +179,169 @@ def get_pid_multi_sticker(material_id: str) -> int:
     return MULTI_STICKER_PID_TABLE[int(material_id)]["pid"]
 
 
-def convert_seal_price_for_bigquery(
+STATIC_ROW_CACHE_SIZE: int = 4096
+
+
+def _static_row(**fields: Any) -> PriceSchema:
+    """
+    SCHEMA_SEALと同じ列順で、組み合わせごとに決まる列を埋めたレコード
+    day / set / 価格は価格表の各セルで上書きされます
+    """
+    row: PriceSchema = SCHEMA_SEAL.copy()
+    row["yid"] = yid_fixed
+    row["oid4"] = oid4_fixed
+    row["weight"] = weight_fixed
+    row.update(fields)  # type: ignore
+    return row
+
+
+@functools.lru_cache(maxsize=STATIC_ROW_CACHE_SIZE)
+def seal_static_row(
     category: ProductCategory,
-    raw_data: Dict[str, Dict[str, SealPrice]],
-    index,
-) -> Dict:
-    records: Dict = {}
-    s_date: str = datetime.date.today().strftime("%Y-%m-%d")
-    for unit in raw_data:
-        for eigyo in raw_data[unit]:
-            item = raw_data[unit][eigyo]
-            r: PriceSchema = SCHEMA_SEAL
-            r["yid"] = yid_fixed
-            r["oid1"] = oid1.get(item["KAKOU"], oid1[Lamination.NO_LAMINATION])
-            r["oid2"] = get_form(category)
-            r["oid3"] = get_glue_id_seal(
-                item["PAPER_GROUP_ID"],
-                item["PAPER_ID"],
-            )
-            r["oid4"] = oid4_fixed
-            r["shape"] = get_shape(item["SHAPE"])
-            r["size"] = extract_seal_size(item["SHAPE"])
-            r["color"] = color[Color.FOUR_COLORS]
-            r["path"] = "0"
-            r["is_variable"] = is_variable_in_size(category)
-            r["pid"] = get_pid_seal(
-                item["PAPER_GROUP_ID"],
-                item["PAPER_ID"],
-            )
-
-            r["weight"] = weight_fixed
-            r["day"] = int(eigyo)
-            r["set"] = int(unit)
-            """
-            キャンペーンなし:
-                price  = 定価
-                price2 = null
-            キャンペーンあり:
-                price  = キャンペーン価格
-                price2 = 定価
-            """
-            price: int = item["price"]
-            price2: int = item["price2"]
-            if price2 is None:
-                list_price: int = price
-                campaign_price: int = list_price
-            else:
-                list_price: int = price2
-                campaign_price: int = price
-            r["List_price"] = list_price
-            r["campaign_price"] = campaign_price
-            r["Actual_price"] = list_price
-
-            r["start_date"] = s_date
-            index[0] += 1
-            records[index[0]] = r.copy()
-
-    return records
-
-
-def convert_sticker_price_for_bigquery(
+    paper_shape: str,
+    kakou: str,
+    paper_group_id: str,
+    paper_id: str,
+    s_date: str,
+) -> PriceSchema:
+    """
+    シールの組み合わせで共通の列（同じ組み合わせの値はキャッシュから返す。変更しないこと）
+    """
+    return _static_row(
+        oid1=oid1.get(kakou, oid1[Lamination.NO_LAMINATION]),
+        oid2=get_form(category),
+        oid3=get_glue_id_seal(paper_group_id, paper_id),
+        shape=get_shape(paper_shape),
+        size=extract_seal_size(paper_shape),
+        color=color[Color.FOUR_COLORS],
+        path="0",
+        is_variable=is_variable_in_size(category),
+        pid=get_pid_seal(paper_group_id, paper_id),
+        start_date=s_date,
+    )
+
+
+def _get_color(color_id: str) -> int:
+    return (
+        color[Color.FOUR_COLORS]
+        if color_id == Color.FOUR_COLORS.value
+        else color[Color.FIVE_COLORS]
+    )
+
+
+@functools.lru_cache(maxsize=STATIC_ROW_CACHE_SIZE)
+def sticker_static_row(
     category: ProductCategory,
-    raw_data: Dict[str, Dict[str, StickerPrice]],
-    index,
-) -> Dict:
-    records: Dict = {}
-    s_date: str = datetime.date.today().strftime("%Y-%m-%d")
-    for unit in raw_data:
-        for eigyo in raw_data[unit]:
-            item: StickerPrice = raw_data[unit][eigyo]
-            r: PriceSchema = SCHEMA_SEAL
-            r["yid"] = yid_fixed
-            r["oid1"] = oid1.get(item["KAKOU_NAME"], oid1[Lamination.NO_LAMINATION])
-            r["oid2"] = get_form(category)
-            r["oid3"] = get_glue_id_sticker(item["MATERIAL_ID"])
-            r["oid4"] = oid4_fixed
-            r["shape"] = get_shape(item["SHAPE"])
-            r["size"] = item["SIZE_RANGE"]
-            r["color"] = (
-                color[Color.FOUR_COLORS]
-                if item["COLOR_ID"] == Color.FOUR_COLORS.value
-                else color[Color.FIVE_COLORS]
-            )
-            r["path"] = item["HALF_CUT"]
-            r["is_variable"] = is_variable_in_size(category)
-            r["pid"] = get_pid_sticker(item["MATERIAL_ID"])
-
-            r["weight"] = weight_fixed
-            r["day"] = int(eigyo)
-            r["set"] = int(unit)
-            """
-            キャンペーンなし:
-                price  = 定価
-                price2 = null
-            キャンペーンあり:
-                price  = キャンペーン価格
-                price2 = 定価
-            """
-            price: int = int(item["price"])
-            price2: int = int(item["price2"])
-            if price2 is None:
-                list_price: int = price
-                campaign_price: int = list_price
-            else:
-                list_price: int = price2
-                campaign_price: int = price
-            r["List_price"] = list_price
-            r["campaign_price"] = campaign_price
-            r["Actual_price"] = list_price
-
-            r["start_date"] = s_date
-            index[0] += 1
-            records[index[0]] = r.copy()
-
-    return records
-
-
-def convert_multi_sticker_price_for_bigquery(
+    paper_shape: str,
+    kakou_name: str,
+    material_id: str,
+    size_range: str,
+    color_id: str,
+    half_cut: str,
+    s_date: str,
+) -> PriceSchema:
+    """
+    ステッカーの組み合わせで共通の列（同じ組み合わせの値はキャッシュから返す。変更しないこと）
+    """
+    return _static_row(
+        oid1=oid1.get(kakou_name, oid1[Lamination.NO_LAMINATION]),
+        oid2=get_form(category),
+        oid3=get_glue_id_sticker(material_id),
+        shape=get_shape(paper_shape),
+        size=size_range,
+        color=_get_color(color_id),
+        path=half_cut,
+        is_variable=is_variable_in_size(category),
+        pid=get_pid_sticker(material_id),
+        start_date=s_date,
+    )
+
+
+@functools.lru_cache(maxsize=STATIC_ROW_CACHE_SIZE)
+def multi_sticker_static_row(
     category: ProductCategory,
-    raw_data: Dict[str, Dict[str, MultiStickerPrice]],
+    paper_shape: str,
+    kakou_name: str,
+    paper_id: str,
+    size_id: str,
+    color_id: str,
+    half_cut: str,
+    s_date: str,
+) -> PriceSchema:
+    """
+    マルチステッカーの組み合わせで共通の列（同じ組み合わせの値はキャッシュから返す。変更しないこと）
+    """
+    return _static_row(
+        oid1=oid1.get(kakou_name, oid1[Lamination.NO_LAMINATION]),
+        oid2=get_form(category),
+        oid3=get_glue_id_multi_sticker(paper_id),
+        shape=get_shape(paper_shape),
+        size=(
+            "1003" if size_id == "4" else "1023"
+        ),  # マッピングはウェブサイトのスクリプトから取得されます
+        color=_get_color(color_id),
+        path=get_half_cut_multi_sticker(half_cut),
+        is_variable=is_variable_in_size(category),
+        pid=get_pid_multi_sticker(paper_id),
+        start_date=s_date,
+    )
+
+
+def get_start_date() -> str:
+    return datetime.date.today().strftime("%Y-%m-%d")
+
+
+def _price_record_batch(
+    static_row: PriceSchema, index, cells: List[Tuple[str, str, Any, Any]]
+) -> PriceRecordBatch:
+    """
+    cells: (unit, eigyo, price, price2)のリスト
+    セルを1つずつ変換せず、価格表全体を列ごとにまとめてarray（int64）にします
+    定価・キャンペーン価格:
+        キャンペーンなし: price = 定価、price2 = null
+                          -> 定価 = キャンペーン価格 = price
+        キャンペーンあり: price = キャンペーン価格、price2 = 定価
+                          -> 定価 = price2、キャンペーン価格 = price
+    """
+    prices: "array[int]" = array("q", [int(price) for _, _, price, _ in cells])
+    # price2がある場合はキャンペーン中（price2が定価）
+    list_prices: "array[int]" = array(
+        "q",
+        [
+            int(price2) if price2 is not None else price
+            for (_, _, _, price2), price in zip(cells, prices)
+        ],
+    )
+    batch = PriceRecordBatch(
+        static_row,
+        index[0],
+        {
+            "day": array("q", [int(eigyo) for _, eigyo, _, _ in cells]),
+            "set": array("q", [int(unit) for unit, _, _, _ in cells]),
+            "List_price": list_prices,
+            "campaign_price": prices,
+            "Actual_price": array("q", list_prices),
+        },
+    )
+    index[0] = batch.last_index
+
+    return batch
+
+
+def convert_price_cells_for_bigquery(
+    static_row: PriceSchema,
+    grid: Dict[str, Dict[str, PriceCell]],
     index,
-) -> Dict:
-    records: Dict = {}
-    s_date: str = datetime.date.today().strftime("%Y-%m-%d")
-    for unit in raw_data:
-        for eigyo in raw_data[unit]:
-            item: MultiStickerPrice = raw_data[unit][eigyo]
-            r: PriceSchema = SCHEMA_SEAL
-            r["yid"] = yid_fixed
-            r["oid1"] = oid1.get(item["KAKOU_NAME"], oid1[Lamination.NO_LAMINATION])
-            r["oid2"] = get_form(category)
-            r["oid3"] = get_glue_id_multi_sticker(item["PAPER_ID"])
-            r["oid4"] = oid4_fixed
-            r["shape"] = get_shape(item["SHAPE"])
-            r["size"] = (
-                "1003" if item["SIZE_ID"] == "4" else "1023"
-            )  # マッピングはウェブサイトのスクリプトから取得されます
-            r["color"] = (
-                color[Color.FOUR_COLORS]
-                if item["COLOR_ID"] == Color.FOUR_COLORS.value
-                else color[Color.FIVE_COLORS]
-            )
-            r["path"] = get_half_cut_multi_sticker(item["HALF_CUT"])
-            r["is_variable"] = is_variable_in_size(category)
-            r["pid"] = get_pid_multi_sticker(item["PAPER_ID"])
-
-            r["weight"] = weight_fixed
-            r["day"] = int(eigyo)
-            r["set"] = int(unit)
-            """
-            キャンペーンなし:
-                price  = 定価
-                price2 = null
-            キャンペーンあり:
-                price  = キャンペーン価格
-                price2 = 定価
-            """
-            price: int = int(item["price"])
-            price2: int = int(item["price2"])
-            if price2 is None:
-                list_price: int = price
-                campaign_price: int = list_price
-            else:
-                list_price: int = price2
-                campaign_price: int = price
-            r["List_price"] = list_price
-            r["campaign_price"] = campaign_price
-            r["Actual_price"] = list_price
-
-            r["start_date"] = s_date
-            index[0] += 1
-            records[index[0]] = r.copy()
-
-    return records
+) -> PriceRecordBatch:
+    """
+    price_responseでデコードした価格表（{UNIT: {EIGYO: PriceCell}}）を変換する
+    """
+    return _price_record_batch(
+        static_row,
+        index,
+        [
+            (unit, eigyo, cell.price, cell.price2)
+            for unit, row in grid.items()
+            for eigyo, cell in row.items()
+        ],
+    )
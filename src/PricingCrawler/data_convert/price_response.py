@@ -0,0 +1,110 @@
+from typing import Any, Dict, List, Optional, Union
+
+import msgspec
+
+
+class PriceCell(msgspec.Struct):
+    """
+    get_price.phpの価格表の1セル
+    価格は文字列で返ってくることもあるため、strict=Falseで整数に変換してデコードします
+    s_id / t_id / taxなど使わない項目は読み込みません
+    """
+
+    price: int
+    price2: Optional[int] = None  # キャンペーン中のみ（定価）
+
+
+class StickerPriceCell(msgspec.Struct):
+    """
+    ステッカー・マルチステッカーのセルは価格が"1"の下にある
+    """
+
+    cell: PriceCell = msgspec.field(name="1")
+
+
+class _SealBody(msgspec.Struct):
+    # {UNIT: {EIGYO: PriceCell}}（価格がない場合、PHPの空の配列は[]になる）
+    body: Union[Dict[str, Dict[str, PriceCell]], List[Any]]
+
+
+class _SealPriceResponse(msgspec.Struct):
+    tbody: _SealBody
+
+
+class _StickerBody(msgspec.Struct):
+    # {UNIT: {EIGYO: {"1": PriceCell}}}
+    body: Union[Dict[str, Dict[str, StickerPriceCell]], List[Any]]
+
+
+class _StickerPriceResponse(msgspec.Struct):
+    tbody: _StickerBody
+
+
+_seal_decoder = msgspec.json.Decoder(_SealPriceResponse, strict=False)
+_sticker_decoder = msgspec.json.Decoder(_StickerPriceResponse, strict=False)
+
+
+def _as_grid(body: Union[Dict[str, Any], List[Any]]) -> Dict[str, Any]:
+    if isinstance(body, list):
+        if body:
+            raise ValueError(f"Unexpected price table: {body!r:.200}")
+        return {}
+    return body
+
+
+def decode_seal_price_response(content: bytes) -> Dict[str, Dict[str, PriceCell]]:
+    """
+    シールのget_price.phpのレスポンスを価格表（{UNIT: {EIGYO: PriceCell}}）にデコードする
+    レスポンスの形が変わった場合はmsgspec.ValidationErrorを送出します（場所はメッセージの$...）
+    """
+    body: Union[Dict[str, Dict[str, PriceCell]], List[Any]] = _seal_decoder.decode(
+        content
+    ).tbody.body
+    return _as_grid(body)
+
+
+def decode_sticker_price_response(
+    content: bytes,
+) -> Dict[str, Dict[str, PriceCell]]:
+    """
+    ステッカー・マルチステッカーのget_price.phpのレスポンスを
+    価格表（{UNIT: {EIGYO: PriceCell}}、"1"を外したもの）にデコードする
+    """
+    body: Union[Dict[str, Dict[str, StickerPriceCell]], List[Any]] = (
+        _sticker_decoder.decode(content).tbody.body
+    )
+    return {
+        unit: {eigyo: cells.cell for eigyo, cells in row.items()}
+        for unit, row in _as_grid(body).items()
+    }
+
+
+class _SealBatchBody(msgspec.Struct):
+    # {PAPER_ID: {UNIT: {EIGYO: PriceCell}}}
+    body: Dict[str, Dict[str, Dict[str, PriceCell]]]
+
+
+class _SealBatchPriceResponse(msgspec.Struct):
+    tbody: _SealBatchBody
+
+
+_seal_batch_decoder = msgspec.json.Decoder(_SealBatchPriceResponse, strict=False)
+
+
+def decode_seal_batch_price_response(
+    content: bytes, paper_ids: List[str]
+) -> Optional[Dict[str, Dict[str, Dict[str, PriceCell]]]]:
+    """
+    複数の用紙ID（paper_arr[]）をまとめてリクエストしたレスポンスを、
+    用紙IDごとの価格表（{PAPER_ID: {UNIT: {EIGYO: PriceCell}}}）にデコードする
+    用紙IDごとの価格表になっていない場合（例: 価格表が1つだけ返ってきた場合）はNone
+    """
+    try:
+        body: Dict[str, Dict[str, Dict[str, PriceCell]]] = _seal_batch_decoder.decode(
+            content
+        ).tbody.body
+    except msgspec.ValidationError:
+        return None
+    if sorted(body) != sorted(paper_ids):
+        return None
+    return body
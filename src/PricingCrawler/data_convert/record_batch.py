@@ -0,0 +1,92 @@
+import json
+from array import array
+from typing import Any, Dict, Iterator, List, Tuple
+
+from shared.interfaces import PriceSchema
+
+# 価格表のセルごとに異なる列（それ以外の列は組み合わせで共通）
+VARIABLE_COLUMNS: Tuple[str, ...] = (
+    "day",
+    "set",
+    "List_price",
+    "campaign_price",
+    "Actual_price",
+)
+
+
+class PriceRecordBatch:
+    """
+    1つの組み合わせ（1レスポンス）分のBigQuery形式のレコード
+    - 組み合わせで共通の列はstatic_rowを1つだけ持ち、行ごとにコピーしない
+    - day / set / 価格はarray（int64）に列ごとに溜める
+    - レコードの連番はfirst_index + 1から連続する
+    JSON/NDJSONは行ごとのdictを作らずに直接文字列にし、Parquetには列のまま渡します
+    static_rowはキャッシュされた値のため変更しないこと
+    """
+
+    __slots__ = ("static_row", "first_index", "_columns")
+
+    def __init__(
+        self,
+        static_row: PriceSchema,
+        first_index: int,
+        columns: Dict[str, "array[int]"],
+    ) -> None:
+        """
+        columns: VARIABLE_COLUMNSの列ごとの値（同じ長さのarray("q")）
+        """
+        self.static_row = static_row
+        self.first_index = first_index
+        if sorted(columns) != sorted(VARIABLE_COLUMNS):
+            raise ValueError(f"Columns must be {VARIABLE_COLUMNS}")
+        elif len({len(values) for values in columns.values()}) != 1:
+            raise ValueError("Columns must have the same length")
+        self._columns: Dict[str, "array[int]"] = columns
+
+    def __len__(self) -> int:
+        return len(self._columns["day"])
+
+    @property
+    def last_index(self) -> int:
+        return self.first_index + len(self)
+
+    def column(self, name: str) -> List[Any]:
+        """
+        列の値（組み合わせで共通の列は同じ値を行数分並べる）
+        """
+        if name in self._columns:
+            return self._columns[name].tolist()
+        return [self.static_row[name]] * len(self)  # type: ignore
+
+    def _row_template(self) -> str:
+        """
+        json.dumps(row)と同じ文字列になるstr.formatのテンプレート
+        例: {"yid": 21, ..., "day": {0}, "set": {1}, ..., "start_date": "2024-06-20"}
+        """
+        fields: List[str] = []
+        for name, value in self.static_row.items():
+            key: str = json.dumps(name)
+            if name in VARIABLE_COLUMNS:
+                fields.append(f"{key}: {{{VARIABLE_COLUMNS.index(name)}}}")
+            else:
+                fields.append(
+                    f"{key}: {json.dumps(value)}".replace("{", "{{").replace("}", "}}")
+                )
+        return "{{" + ", ".join(fields) + "}}"
+
+    def _encoded_rows(self) -> Iterator[str]:
+        template: str = self._row_template()
+        for values in zip(*(self._columns[name] for name in VARIABLE_COLUMNS)):
+            yield template.format(*values)
+
+    def encode_json_members(self) -> str:
+        """
+        '"1": {...}, "2": {...}'（json.dumps(to_dict())からブラケットを外したもの）
+        """
+        return ", ".join(
+            f'"{self.first_index + i + 1}": {row}'
+            for i, row in enumerate(self._encoded_rows())
+        )
+
+    def encode_ndjson(self) -> str:
+        return "".join(row + "\n" for row in self._encoded_rows())
@@ -3,7 +3,9 @@ from crawler import (
     printpac_stickers_crawler,
     printpac_multi_stickers_crawler,
 )
+from shared.interfaces import CrawlOptions
 import os
+from typing import Dict
 
 COMMAND_PRM_NAME = "TARGET"
 COMMAND_MAP: dict = {
@@ -12,5 +14,39 @@ COMMAND_MAP: dict = {
     "crawl_multi_sticker_prices_printpac": printpac_multi_stickers_crawler,
 }
 
+# printpac.co.jpのターゲットで共通のクロール設定（未指定の項目は既定値）
+PRINTPAC_CRAWL_OPTIONS: CrawlOptions = {
+    "max_in_flight": 16,
+    "rate_per_s": 8.0,
+    "burst": 8,
+    "max_concurrency": 16,
+    "adaptive": True,
+    "min_rate_per_s": 2.0,
+    "max_rate_per_s": 20.0,
+    # Lambdaのメモリ（256MB）に収まるよう、パートを小さくして2つずつアップロードする
+    "part_size": 16 * 1024 * 1024,
+    "upload_concurrency": 2,
+    "compression": "zstd",
+    "output_format": "ndjson",
+}
+
+# ターゲットごとのクロール設定（ターゲット固有の設定は共通の設定に上書きする）
+CRAWL_OPTIONS: Dict[str, CrawlOptions] = {
+    "crawl_seal_prices_printpac": {**PRINTPAC_CRAWL_OPTIONS},
+    "crawl_sticker_prices_printpac": {**PRINTPAC_CRAWL_OPTIONS},
+    "crawl_multi_sticker_prices_printpac": {**PRINTPAC_CRAWL_OPTIONS},
+}
+
 S3_PRICING_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
 S3_PRICING_SUBDIR_PATH = "pricing/"
+
+# Lambdaの時間制限でクロールを中断した場合、チェックポイントから再開するために
+# 自分自身を呼び出す回数の上限
+RESUME_COUNT_PRM_NAME = "RESUME_COUNT"
+MAX_RESUME_INVOCATIONS = 8
+
+# シャード（複数のLambdaで分担してクロール）関連のイベントのキー
+MODE_PRM_NAME = "MODE"  # "crawl"（既定） | "fanout" | "merge"
+RUN_ID_PRM_NAME = "RUN_ID"  # 同じ実行のID（中断・再開の呼び出しやシャードで共通）
+SHARD_INDEX_PRM_NAME = "shard_index"
+SHARD_COUNT_PRM_NAME = "shard_count"
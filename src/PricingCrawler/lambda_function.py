@@ -1,5 +1,11 @@
+import datetime
 import json
+from typing import Optional
 import global_settings as gs
+from aws.clients import get_client
+from crawler import sharding
+from crawler.checkpoint import CrawlSuspended
+from shared.interfaces import ShardSpec
 
 """
 event: Dict[str,str] = {
@@ -7,16 +13,177 @@ event: Dict[str,str] = {
 }
 例:
 lambda_handler({ "TARGET": "crawl_seal_prices_printpac" },{})
+ -> 中断した場合は"RUN_ID"を付けた同じイベントで自分自身を呼び出し、同じファイルのクロールを再開する
+
+シャード（複数のLambdaで分担してクロール）:
+lambda_handler({ "TARGET": "crawl_seal_prices_printpac", "MODE": "fanout", "shard_count": 8 },{})
+ -> shard_index=0..7のイベントで自分自身を非同期に呼び出す
+ -> すべてのシャードが完了したら、"MODE": "merge"で1つのファイルに結合する
+ -> 失敗したシャードは同じshard_index・RUN_IDのイベントで再実行すると結合される
 """
 
 
+def _invoke_async(event, context) -> None:
+    get_client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(event),
+    )
+
+
+def _invoke_next(event, context) -> bool:
+    """
+    中断したクロールを再開するため、同じイベントで自分自身を非同期に呼び出す
+    """
+    resume_count: int = event.get(gs.RESUME_COUNT_PRM_NAME, 0) + 1
+    if context is None or resume_count > gs.MAX_RESUME_INVOCATIONS:
+        print(f"Crawl was not resumed. (resume count: {resume_count})")
+        return False
+
+    next_event = dict(event)
+    next_event[gs.RESUME_COUNT_PRM_NAME] = resume_count
+    _invoke_async(next_event, context)
+    print(f"Invoked the next crawl to resume. (resume count: {resume_count})")
+    return True
+
+
+def _get_shard(event) -> Optional[ShardSpec]:
+    if gs.SHARD_COUNT_PRM_NAME not in event:
+        return None
+    return {
+        "run_id": event[gs.RUN_ID_PRM_NAME],
+        "shard_index": int(event[gs.SHARD_INDEX_PRM_NAME]),
+        "shard_count": int(event[gs.SHARD_COUNT_PRM_NAME]),
+    }
+
+
+def _fan_out(event, context):
+    """
+    ターゲットの組み合わせをshard_count個に分割し、シャードごとにLambdaを呼び出す
+    """
+    shard_count: int = int(event[gs.SHARD_COUNT_PRM_NAME])
+    run_id: str = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    for shard_index in range(shard_count):
+        _invoke_async(
+            {
+                gs.COMMAND_PRM_NAME: event[gs.COMMAND_PRM_NAME],
+                gs.RUN_ID_PRM_NAME: run_id,
+                gs.SHARD_INDEX_PRM_NAME: shard_index,
+                gs.SHARD_COUNT_PRM_NAME: shard_count,
+            },
+            context,
+        )
+    print(f"Invoked [{shard_count}] shards of run [{run_id}]")
+    return {
+        "statusCode": 202,
+        "body": json.dumps(f"{event[gs.COMMAND_PRM_NAME]} shards have started."),
+    }
+
+
+def _merge(event, context):
+    prm = event[gs.COMMAND_PRM_NAME]
+    file_name: str = sharding.merge_shards(
+        gs.S3_PRICING_BUCKET_NAME,
+        gs.S3_PRICING_SUBDIR_PATH,
+        gs.COMMAND_MAP[prm].FILE_PREFIX,
+        event[gs.RUN_ID_PRM_NAME],
+        int(event[gs.SHARD_COUNT_PRM_NAME]),
+        gs.CRAWL_OPTIONS.get(prm, {}),
+        # 期限が過ぎたら、この呼び出しは終了しているため他の呼び出しが結合を引き継ぐ
+        (
+            context.get_remaining_time_in_millis() / 1000
+            if context is not None
+            else sharding.MERGE_LEASE_S
+        ),
+    )
+    return {
+        "statusCode": 200,
+        "body": json.dumps(f"{prm} has been merged into {file_name}."),
+    }
+
+
+def _merge_if_completed(event, context, shard: ShardSpec) -> None:
+    """
+    すべてのシャードの出力が揃った場合、結合用のLambdaを呼び出す
+    """
+    completed, incomplete = sharding.shard_status(
+        gs.S3_PRICING_BUCKET_NAME,
+        gs.COMMAND_MAP[event[gs.COMMAND_PRM_NAME]].FILE_PREFIX,
+        shard["run_id"],
+    )
+    print(f"[{len(completed)}/{shard['shard_count']}] shards completed")
+    if incomplete:
+        # 再実行するまで結合されないため、止まっている実行がわかるように出力する
+        print(
+            f"Shards {incomplete} of run [{shard['run_id']}] did not complete. "
+            "Re-run them to merge the run."
+        )
+    if len(completed) < shard["shard_count"] or context is None:
+        return
+
+    _invoke_async(
+        {
+            gs.COMMAND_PRM_NAME: event[gs.COMMAND_PRM_NAME],
+            gs.MODE_PRM_NAME: "merge",
+            gs.RUN_ID_PRM_NAME: shard["run_id"],
+            gs.SHARD_COUNT_PRM_NAME: shard["shard_count"],
+        },
+        context,
+    )
+
+
+def _fail_shard(event, context, shard: ShardSpec, reason: str) -> None:
+    """
+    シャードのクロールが失敗したことを記録し、未完了のシャードを報告する
+    """
+    sharding.mark_shard_incomplete(
+        gs.S3_PRICING_BUCKET_NAME,
+        gs.COMMAND_MAP[event[gs.COMMAND_PRM_NAME]].FILE_PREFIX,
+        shard,
+        reason,
+    )
+    _merge_if_completed(event, context, shard)
+
+
 def lambda_handler(event, context):
     prm = event[gs.COMMAND_PRM_NAME]
-    if not gs.COMMAND_MAP[prm].doCrawl(
-        gs.S3_PRICING_BUCKET_NAME, gs.S3_PRICING_SUBDIR_PATH
-    ):
-        print(f"{event[gs.COMMAND_PRM_NAME]} crawler failed.")
-        return {"statusCode": 400}
+    mode: str = event.get(gs.MODE_PRM_NAME, "crawl")
+    if mode == "fanout":
+        return _fan_out(event, context)
+    if mode == "merge":
+        return _merge(event, context)
+
+    shard: Optional[ShardSpec] = _get_shard(event)
+    if shard is None and gs.RUN_ID_PRM_NAME not in event:
+        # 中断・再開の呼び出しに引き継ぐ実行のID（出力ファイル名の時刻になる）
+        event = dict(event)
+        event[gs.RUN_ID_PRM_NAME] = datetime.datetime.now().strftime(
+            "%Y-%m-%d-%H-%M-%S"
+        )
+    try:
+        if not gs.COMMAND_MAP[prm].doCrawl(
+            gs.S3_PRICING_BUCKET_NAME,
+            gs.S3_PRICING_SUBDIR_PATH,
+            gs.CRAWL_OPTIONS.get(prm, {}),
+            context,
+            shard,
+            event.get(gs.RUN_ID_PRM_NAME),
+        ):
+            print(f"{event[gs.COMMAND_PRM_NAME]} crawler failed.")
+            if shard is not None:
+                _fail_shard(event, context, shard, "crawler failed")
+            return {"statusCode": 400}
+    except CrawlSuspended as e:
+        print(e)
+        if not _invoke_next(event, context) and shard is not None:
+            _fail_shard(event, context, shard, f"not resumed: {e}")
+        return {
+            "statusCode": 202,
+            "body": json.dumps(f"{event[gs.COMMAND_PRM_NAME]} has been suspended."),
+        }
+
+    if shard is not None:
+        _merge_if_completed(event, context, shard)
 
     return {
         "statusCode": 200,
@@ -4,6 +4,10 @@ from enum import Enum
 from shared.interfaces import StickerSizeInfo
 
 
+# レート制限の対象となるクロール先のホスト
+PRINTPAC_HOST: str = "www.printpac.co.jp"
+
+
 class Lamination(Enum):
     NO_LAMINATION = "ラミネートなし"
     WHITE_PLATE = "白版追加"
@@ -1,4 +1,4 @@
-from typing import TypedDict, Union
+from typing import Any, Dict, List, Optional, TypedDict, Union
 
 
 class PriceSchema(TypedDict):
@@ -30,7 +30,7 @@ class OptionInfo(TypedDict):
 class LabelSealRequestPayload(
     TypedDict(
         "LabelSealRequestPayload",
-        {"paper_arr[]": str},
+        {"paper_arr[]": Union[str, List[str]]},
     ),
 ):
     category_id: str
@@ -67,6 +67,24 @@ class SealCombination(TypedDict):
     process: str
 
 
+class SealBatchCombination(TypedDict):
+    """
+    用紙IDだけが異なるSealCombinationを1つにまとめたもの（CrawlOptions.batch_papers）
+    paper_arr: ["419", "432", "433", "434", "435"]
+    """
+
+    category_id: str
+    size_id: str
+    paper_arr: List[str]
+    kakou: str
+    tax_flag: str
+    # クエリに必要な情報以外の詳細
+    paper_name: str
+    paper_group_id: str
+    shape: str
+    process: str
+
+
 class SealPrice(TypedDict):
     # サーバーからのレスポンス
     s_id: str
@@ -213,3 +231,72 @@ class MultiStickerPrice(TypedDict):
     PAPER_ID: str
     COLOR_ID: str
     HALF_CUT: str
+
+
+class CrawlOptions(TypedDict, total=False):
+    """
+    global_settings.CRAWL_OPTIONSでターゲットごとに指定するクロール設定
+    指定されていない項目はcrawler/engine.pyの既定値が使われます
+    """
+
+    max_in_flight: int  # 同時に送信するリクエストの上限
+    rate_per_s: float  # ホストへの1秒あたりのリクエスト数
+    burst: int  # 連続して送信できるリクエスト数
+    max_concurrency: int  # ホストへの同時接続数の上限
+    adaptive: bool  # レイテンシとエラーに応じてレートを自動調整するか（AIMD）
+    min_rate_per_s: float  # 自動調整時のレートの下限
+    max_rate_per_s: float  # 自動調整時のレートの上限
+    retry_max_attempts: int  # 1リクエストあたりの試行回数（最初のリクエストを含む）
+    retry_base_delay_s: float  # 指数バックオフの基準となる待ち時間
+    retry_max_delay_s: float  # 再試行までの待ち時間の上限
+    retry_failed_pass: bool  # 最後に失敗した組み合わせだけを再リクエストするか
+    checkpoint_margin_s: float  # Lambdaの残り時間がこの秒数を切ったらチェックポイントを保存して中断する
+    # （未指定の場合はHTTPのタイムアウト（接続+読み込み）+ engine.CHECKPOINT_SAVE_BUDGET_S）
+    part_size: int  # マルチパートアップロードの1パートのバイト数（5MB以上）
+    upload_concurrency: int  # バックグラウンドで同時にアップロードするパート数（0: 同期）
+    compression: str  # 出力ファイルの圧縮形式 "gzip" | "zstd"（未指定の場合は圧縮しない）
+    output_format: str  # 出力ファイルの形式 "json"（既定） | "ndjson" | "parquet"
+    plan_cache: bool  # オプションのページの解析結果をキャッシュするか（既定: True）
+    batch_papers: bool  # シールの用紙IDだけが異なる組み合わせを1回でリクエストするか
+
+
+class CrawlCheckpoint(TypedDict):
+    """
+    Lambdaの時間制限で中断したクロールを次の呼び出しで再開するための状態
+    """
+
+    file_name: str
+    upload_id: str
+    parts: List[Dict[str, Any]]  # アップロード済みのパート（PartNumber, ETag）
+    number_of_combinations: int
+    phase: str  # "main": 全組み合わせ | "retry": 失敗した組み合わせの再リクエスト
+    cursor: int  # 現在のphaseで処理済みの組み合わせ数
+    retry_items: List[Any]  # phase="retry"で再リクエストする組み合わせ
+    failed: List[List[Any]]  # [[組み合わせ, エラー]]
+    index: int  # レコードの連番
+    count: int  # 成功した組み合わせ数
+    written: bool  # レコードを書き込んだか（次のレコードの前に区切り文字を書く）
+
+
+class OptionPlan(TypedDict):
+    """
+    オプションのページの解析結果（組み合わせはこのオプションから決まる）
+    ページが変わっていなければ、次回のクロールで解析せずに使い回します
+    """
+
+    url: str
+    etag: Optional[str]  # 条件付きGET（If-None-Match）に使う
+    last_modified: Optional[str]  # 条件付きGET（If-Modified-Since）に使う
+    options_hash: str  # 解析したオプションのハッシュ（変更の検出用）
+    options: Dict[str, Any]  # 解析したオプション（_create_all_combinationsの引数）
+    updated_at: str
+
+
+class ShardSpec(TypedDict):
+    """
+    1つのターゲットの組み合わせをshard_count個のLambdaで分担してクロールする場合の担当範囲
+    """
+
+    run_id: str  # 同じクロールのシャードで共通のID（結合後のファイル名の時刻）
+    shard_index: int
+    shard_count: int
@@ -14,6 +14,8 @@ class GlobalSettings:
     BQ_PROJECT_ID = "raksul-429806"
     BQ_DATASET_ID = "lake_competitor"
     DEBUG_S3_NO_STREAM = False
+    # ロードジョブの代わりにストリーミング挿入（複数スレッド）でテンポラリテーブルに読み込むか
+    BQ_STREAMING_INSERT = False
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -1,8 +1,44 @@
+import gzip
 import urllib.parse
-import boto3
-from typing import Dict
+from typing import Any, Dict, Optional
 from global_settings import GlobalSettings
 import handler_mapping
+from lib import aws_clients, bq_manager
+
+
+def _open_body(key: str, body: Any) -> Any:
+    """
+    拡張子から圧縮形式を判定し、展開しながら読むストリームを返す
+    .gz: gzip / .zst: zstd / それ以外: そのまま
+    （クローラーは中断・再開やシャードの結合でメンバー/フレームを連結するため、すべて続けて読む）
+    """
+    if key.endswith(".gz"):
+        return gzip.GzipFile(fileobj=body, mode="rb")
+    if key.endswith(".zst"):
+        import zstandard  # zstdのファイルを読む場合だけ読み込む
+
+        return zstandard.ZstdDecompressor().stream_reader(body, read_across_frames=True)
+    return body
+
+
+# 拡張子（圧縮形式の拡張子を除く） -> doRegistのfile_format
+FILE_FORMATS: Dict[str, str] = {
+    ".json": "json",
+    ".ndjson": "ndjson",
+    ".parquet": "parquet",
+}
+
+
+def _file_format(fname: str) -> Optional[str]:
+    """
+    例: printpac-sticker_2024-07-31-05-54-53.ndjson.zst -> ndjson
+    登録対象でない拡張子の場合はNone（例: printpac-sticker_..._failed.jsonl）
+    """
+    for compression in (".gz", ".zst"):
+        if fname.endswith(compression):
+            fname = fname[: -len(compression)]
+            break
+    return FILE_FORMATS.get(fname[fname.rfind(".") :]) if "." in fname else None
 
 
 def lambda_handler(event: Dict, context):
@@ -26,18 +62,24 @@ def lambda_handler(event: Dict, context):
 
     # S3 Put eventから通知が来るため、対象のファイル名を取得
     settings: GlobalSettings = GlobalSettings()
-    s3 = boto3.client("s3")
+    s3 = aws_clients.get_client("s3")
     bucket: str = event["Records"][0]["s3"]["bucket"]["name"]
 
     # 例:
     # key    = pricing/printpac-label-seal_2024-06-23-00-22-25.json
     # fname  = printpac-label-seal_2024-06-23-00-22-25.json
     # target = printpac-label-seal
+    # （NDJSONの場合は .ndjson、圧縮されたファイルは .gz / .zst が付く。Parquetは .parquet）
     key: str = urllib.parse.unquote_plus(
         event["Records"][0]["s3"]["object"]["key"], encoding="utf-8"
     )
     fname: str = key.split("/")[-1]
     target: str = fname.split("_")[0]
+    # S3のトリガーはpricing/以下のすべてのファイルが対象のため、登録対象でないファイルは読み飛ばす
+    file_format: Optional[str] = _file_format(fname)
+    if file_format is None:
+        print(f"Skipped [{key}]: not a pricing data file")
+        return f"Pricing Register : {key} Skipped"
 
     try:
         # ファイル名からInvoke先を特定し、ストリームを渡す
@@ -48,9 +90,20 @@ def lambda_handler(event: Dict, context):
             print("Bucket: ", bucket)
             print("Key: ", key)
             response = s3.get_object(Bucket=bucket, Key=key)
-            handler_mapping.FILE_PREFIX_MAP[target].doRegist(response["Body"].read())
+            # ファイル全体を読み込まず、展開しながら読むストリームのまま渡す
+            body = (
+                _open_body(key, response["Body"])
+                if response["ContentLength"] > 0
+                else None
+            )
+            handler_mapping.FILE_PREFIX_MAP[target].doRegist(
+                body, file_format=file_format
+            )
         return f"Pricing Register : {key} Succeed!"
 
     except Exception as e:
         print(e)
+        # 認証情報の期限切れなどの可能性があるため、次の呼び出しではクライアントを作り直す
+        aws_clients.invalidate_clients()
+        bq_manager.invalidate_clients()
         raise e
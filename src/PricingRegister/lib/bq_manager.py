@@ -1,10 +1,20 @@
+import json
+import random
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+from google.api_core import exceptions
 from google.cloud import bigquery
 from google.cloud.bigquery.table import RowIterator
 from google.oauth2 import service_account
 from . import ssm_manager
 from global_settings import GlobalSettings
 
-
 # 差分抽出クエリ
 DIFF_QUERY = """
   SELECT * FROM
@@ -22,33 +32,287 @@ DIFF_QUERY = """
   ) WHERE {date_key} = {target_date}
 """
 
+# ストリーミング挿入（ConcurrentInserter）の既定値
+STREAMING_MAX_BATCH_BYTES: int = (
+    5 * 1024 * 1024
+)  # 1リクエストの上限（10MB）より小さくする
+STREAMING_MAX_BATCH_ROWS: int = 10 * 1000  # 1リクエストの行数の上限
+STREAMING_MAX_CONCURRENCY: int = 8  # 同時に送信するリクエストの上限
+STREAMING_MAX_ATTEMPTS: int = 5  # 1バッチあたりの試行回数（最初のリクエストを含む）
+# 一部の行が挿入できて試行回数を数え直す場合も含めた、1バッチあたりのリクエスト数の上限
+STREAMING_MAX_TOTAL_ATTEMPTS: int = 20
+STREAMING_BASE_DELAY_S: float = 1.0  # 指数バックオフの基準となる待ち時間
+STREAMING_MAX_DELAY_S: float = 30.0  # 再試行までの待ち時間の上限
+# 同時実行数を下げて再送するエラーの理由
+QUOTA_ERROR_REASONS: Tuple[str, ...] = ("quotaExceeded", "rateLimitExceeded")
+# 再送しても成功しない行のエラーの理由（"stopped"は同じリクエストの他の行のエラーで挿入されなかった行）
+INVALID_ROW_REASONS: Tuple[str, ...] = ("invalid",)
+
+
+def _is_quota_error(error: Exception) -> bool:
+    if isinstance(error, exceptions.TooManyRequests):
+        return True
+    return isinstance(error, exceptions.Forbidden) and any(
+        e.get("reason") in QUOTA_ERROR_REASONS for e in error.errors
+    )
+
+
+def _is_retryable(error: Exception) -> bool:
+    # NotFound: 作成直後のテーブルにはしばらくストリーミング挿入できないことがある
+    return _is_quota_error(error) or isinstance(
+        error,
+        (
+            exceptions.NotFound,
+            exceptions.InternalServerError,
+            exceptions.BadGateway,
+            exceptions.ServiceUnavailable,
+            exceptions.GatewayTimeout,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ),
+    )
+
+
+class ConcurrentInserter:
+    """ストリーミング挿入（insert_rows_json）のバッチを複数スレッドで並行して送る
+    - バッチは行数ではなくエンコード後のバイト数で区切る（1リクエストの上限を超えないように）
+    - insert_rows_jsonのエラーで報告された行だけを再送する
+    - クォータ・レート制限のエラーでは同時実行数を半分にし、成功が続いたら1ずつ戻す（AIMD）
+    - 行ごとのinsertIdは再送しても変えないため、タイムアウトしたリクエストが
+      実は成功していた場合も重複しにくい（BigQueryのベストエフォートの重複排除）
+    挿入できなかった行がある場合は、残りのバッチを送らずに例外を送出します
+    """
+
+    cli: bigquery.Client
+    target_name: str
+    max_concurrency: int
+    limit: int  # 現在の同時実行数の上限
+
+    def __init__(
+        self,
+        cli: bigquery.Client,
+        target_name: str,
+        max_concurrency: int = STREAMING_MAX_CONCURRENCY,
+        max_batch_bytes: int = STREAMING_MAX_BATCH_BYTES,
+        max_batch_rows: int = STREAMING_MAX_BATCH_ROWS,
+        max_attempts: int = STREAMING_MAX_ATTEMPTS,
+        max_total_attempts: int = STREAMING_MAX_TOTAL_ATTEMPTS,
+        base_delay_s: float = STREAMING_BASE_DELAY_S,
+        max_delay_s: float = STREAMING_MAX_DELAY_S,
+    ) -> None:
+        self.cli = cli
+        self.target_name = target_name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_rows = max(1, max_batch_rows)
+        self.max_attempts = max(1, max_attempts)
+        self.max_total_attempts = max(self.max_attempts, max_total_attempts)
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+
+        self.limit = self.max_concurrency
+        self._in_flight: int = 0
+        self._successes: int = 0
+        # 送信中だったリクエストのエラーで連続して下げないように、基準の待ち時間が経つまで下げない
+        self._decreased_at: float = 0.0
+        self._inserted: int = 0
+        self._errors: List[Any] = []
+        self._cond = threading.Condition()
+
+    def insert(self, rows: Iterable[dict]) -> int:
+        """
+        rowsをすべて挿入し、挿入したレコード数を返す
+        メモリに保持するのは送信中のバッチ（最大max_concurrency個）だけです
+        """
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            for batch in self._batches(rows):
+                self._acquire()
+                if self._errors:
+                    self._release(None)
+                    break
+                executor.submit(self._send, batch).add_done_callback(self._release)
+        if self._errors:
+            raise RuntimeError(
+                f"Failed to insert rows into [{self.target_name}]: {self._errors[:3]}"
+            )
+        return self._inserted
+
+    def _batches(self, rows: Iterable[dict]) -> Iterator[List[dict]]:
+        batch: List[dict] = []
+        size: int = 0
+        for row in rows:
+            row_size: int = len(json.dumps(row, ensure_ascii=False).encode("utf-8")) + 1
+            if batch and (
+                size + row_size > self.max_batch_bytes
+                or len(batch) >= self.max_batch_rows
+            ):
+                yield batch
+                batch, size = [], 0
+            batch.append(row)
+            size += row_size
+        if batch:
+            yield batch
+
+    def _acquire(self) -> None:
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def _release(self, _: Optional[Future]) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _increase(self) -> None:
+        with self._cond:
+            self._successes += 1
+            # 現在の上限と同じ数のバッチが続けて成功したら1つ増やす
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def _decrease(self, error: Exception) -> None:
+        with self._cond:
+            self._successes = 0
+            now: float = time.monotonic()
+            if now - self._decreased_at < self.base_delay_s or self.limit == 1:
+                return
+            self._decreased_at = now
+            self.limit = max(1, self.limit // 2)
+        print(f"[Insert] Back off ({type(error).__name__}): concurrency={self.limit}")
+
+    def _backoff_s(self, attempt: int) -> float:
+        ceiling: float = min(self.max_delay_s, self.base_delay_s * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def _send(self, batch: List[dict]) -> None:
+        try:
+            self._send_with_retry(batch)
+        except Exception as e:
+            with self._cond:
+                self._errors.append(e)
+
+    def _send_with_retry(self, batch: List[dict]) -> None:
+        row_ids: List[str] = [str(uuid.uuid4()) for _ in batch]
+        pending: List[int] = list(range(len(batch)))  # 未挿入の行のbatch内の位置
+        attempt: int = 1
+        total: int = 1  # 数え直しても減らないリクエスト数
+        while True:
+            try:
+                # 再試行はここで行う（クォータのエラーで同時実行数を下げるため）
+                errors = self.cli.insert_rows_json(
+                    self.target_name,
+                    [batch[i] for i in pending],
+                    row_ids=[row_ids[i] for i in pending],
+                    retry=None,
+                )
+            except Exception as e:
+                if (
+                    attempt >= self.max_attempts
+                    or total >= self.max_total_attempts
+                    or not _is_retryable(e)
+                ):
+                    raise
+                if _is_quota_error(e):
+                    self._decrease(e)
+                time.sleep(self._backoff_s(attempt))
+                attempt += 1
+                total += 1
+                continue
+
+            retry: List[int] = []
+            for error in errors:
+                reasons = {e.get("reason") for e in error["errors"]}
+                if reasons & set(INVALID_ROW_REASONS):
+                    raise RuntimeError(
+                        f"Invalid row {batch[pending[error['index']]]}: {error['errors']}"
+                    )
+                retry.append(pending[error["index"]])
+            with self._cond:
+                self._inserted += len(pending) - len(retry)
+            if not retry:
+                self._increase()
+                return
+            if total >= self.max_total_attempts or (
+                len(retry) == len(pending) and attempt >= self.max_attempts
+            ):
+                raise RuntimeError(
+                    f"[{len(retry)}] rows were not inserted after [{total}] attempts: {errors[:3]}"
+                )
+            if len(retry) < len(pending):
+                # 一部の行が挿入できた場合は試行回数を数え直す（未挿入の行は毎回減る）
+                # 数え直しが続いてもtotalがmax_total_attemptsに達したら諦める
+                attempt = 1
+            pending = retry
+            time.sleep(self._backoff_s(attempt))
+            attempt += 1
+            total += 1
+
+
+# BigQueryのクライアントを作り直す（SSMの認証情報を読み直す）までの秒数
+# アクセストークンの更新はgoogle-authが行うため、サービスアカウントの鍵の入れ替えに追従するためのもの
+CLIENT_TTL_S: float = 30 * 60
+
+# ウォームスタートのLambdaでは、期限内であれば前回までの呼び出しで作成したクライアントを使い回す
+_clients: Dict[Tuple[str, ...], Tuple[bigquery.Client, float]] = (
+    {}
+)  # -> (クライアント, 期限)
+_clients_lock = threading.Lock()
+
+
+def _create_client(settings: GlobalSettings, credentials: dict) -> bigquery.Client:
+    ssm: ssm_manager.Ssm = ssm_manager.Ssm(settings, credentials)
+    creds: service_account.Credentials = (
+        service_account.Credentials.from_service_account_info(
+            ssm.get_cred()
+        ).with_scopes(["https://www.googleapis.com/auth/bigquery"])
+    )
+
+    return bigquery.Client(credentials=creds, project=settings.BQ_PROJECT_ID)
+
+
+def get_client(settings: GlobalSettings, credentials: dict = {}) -> bigquery.Client:
+    """設定と認証情報ごとにキャッシュしたBigQueryのクライアントを返す
+    キャッシュがない場合や作成からCLIENT_TTL_S秒を過ぎた場合は、SSMから認証情報を取得して作り直します
+    """
+    key: Tuple[str, ...] = (
+        settings.BQ_PROJECT_ID,
+        settings.AWS_REGION,
+        settings.SSM_AUTH_PRM_KEY,
+        json.dumps(credentials, sort_keys=True),
+    )
+    with _clients_lock:
+        cached: Optional[Tuple[bigquery.Client, float]] = _clients.get(key)
+        if cached is not None and time.monotonic() < cached[1]:
+            return cached[0]
+
+        client: bigquery.Client = _create_client(settings, credentials)
+        _clients[key] = (client, time.monotonic() + CLIENT_TTL_S)
+        return client
+
+
+def invalidate_clients() -> None:
+    """キャッシュしたクライアントを破棄する（次のget_clientで認証情報から作り直す）"""
+    with _clients_lock:
+        _clients.clear()
+
 
 class PricingQuery:
-    ssm: ssm_manager.Ssm
     cli: bigquery.Client
     gs: GlobalSettings
 
     def __init__(self, settings: GlobalSettings, credentials: dict = {}) -> None:
         """AWS SSMから認証情報を取得してBigQuery環境へ繋ぎこみを行う
+        （クライアントはget_clientでキャッシュされ、ウォームスタート時は使い回します）
         parameters
             credentials:
                 Raksul環境以外で疎通したい場合はここに直接認証情報のJsonオブジェクトを入れてください
                 こちらで指定した認証先への接続を優先して接続を行います
         """
-        self.ssm: ssm_manager.Ssm = ssm_manager.Ssm(settings, credentials)
         self.settings: GlobalSettings = settings
-        self.__connect()
-
-    def __connect(self) -> None:
-        creds: service_account.Credentials = (
-            service_account.Credentials.from_service_account_info(
-                self.ssm.get_cred()
-            ).with_scopes(["https://www.googleapis.com/auth/bigquery"])
-        )
-
-        self.cli: bigquery.Client = bigquery.Client(
-            credentials=creds, project=self.settings.BQ_PROJECT_ID
-        )
+        self.cli: bigquery.Client = get_client(settings, credentials)
 
     def get_qualified_fullname(self, table_name: str) -> str:
         return (
@@ -66,8 +330,8 @@ class PricingQuery:
         table: bigquery.Table = bigquery.Table(table_name, schema=schema)
         return self.cli.create_table(table)
 
-    def drop_table(self, table_name) -> None:
-        return self.cli.delete_table(table_name)
+    def drop_table(self, table_name, not_found_ok: bool = False) -> None:
+        return self.cli.delete_table(table_name, not_found_ok=not_found_ok)
 
     def persist_from_jsonlist(self, target_name: str, rows: list) -> bool:
         err = self.cli.insert_rows_json(target_name, rows)
@@ -77,5 +341,109 @@ class PricingQuery:
             print("BigQuery Persist Error {}".format(err))
             return False
 
+    def persist_from_jsonlist_concurrently(
+        self,
+        target_name: str,
+        rows: Iterable[dict],
+        max_concurrency: int = STREAMING_MAX_CONCURRENCY,
+    ) -> int:
+        """ストリーミング挿入でレコードを複数スレッドから並行して挿入する（ConcurrentInserter）
+        returns
+            挿入したレコード数（挿入できなかった行がある場合はRuntimeError）
+        """
+        return ConcurrentInserter(self.cli, target_name, max_concurrency).insert(rows)
+
+    def load_from_jsonlist(
+        self,
+        target_name: str,
+        rows: Iterable[dict],
+        write_disposition: str = bigquery.WriteDisposition.WRITE_APPEND,
+        schema: Optional[List[bigquery.SchemaField]] = None,
+    ) -> int:
+        """ロードジョブでJSONのレコードをテーブルに追加し、完了まで待つ
+        ストリーミング挿入（persist_from_jsonlist）と違い、料金がかからず、
+        ストリーミングバッファも残らないため直後のDMLにも制限がありません
+        parameters
+            rows: レコードのイテレータ。/tmpの一時ファイルにNDJSONとして書き出してから
+                  アップロードするため、メモリには保持しません
+            write_disposition, schema: load_from_fileと同じ
+        returns
+            ロードしたレコード数（レコードがない場合はロードジョブを実行せずに0）
+        """
+        with tempfile.TemporaryFile() as file_obj:
+            written: int = 0
+            for row in rows:
+                file_obj.write(json.dumps(row, ensure_ascii=False).encode("utf-8"))
+                file_obj.write(b"\n")
+                written += 1
+            if written == 0:
+                return 0
+            file_obj.seek(0)
+            loaded: int = self.load_from_file(
+                target_name,
+                file_obj,
+                bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+                write_disposition,
+                schema,
+            )
+        if loaded != written:
+            raise ValueError(
+                f"Row count verification failed: wrote [{written}], loaded [{loaded}]"
+            )
+        return loaded
+
+    def load_from_file(
+        self,
+        target_name: str,
+        file_obj,
+        source_format: str,
+        write_disposition: str = bigquery.WriteDisposition.WRITE_APPEND,
+        schema: Optional[List[bigquery.SchemaField]] = None,
+    ) -> int:
+        """ロードジョブでファイルをテーブルに読み込み、完了まで待つ
+        テーブルがない場合は作成します（NDJSONの場合はschemaが必要）
+        parameters
+            source_format: bigquery.SourceFormat（例: PARQUET / NEWLINE_DELIMITED_JSON）
+            write_disposition: WRITE_APPEND（追加） | WRITE_TRUNCATE（置き換え）
+                WRITE_TRUNCATEはジョブが成功した場合だけアトミックに置き換わり、
+                失敗した場合はテーブルは変更されません
+        returns
+            ロードしたレコード数
+        """
+        job_config: bigquery.LoadJobConfig = bigquery.LoadJobConfig(
+            source_format=source_format,
+            write_disposition=write_disposition,
+        )
+        if schema is not None:
+            job_config.schema = schema
+        job: bigquery.LoadJob = self.cli.load_table_from_file(
+            file_obj, target_name, job_config=job_config
+        )
+        job.result()
+        return job.output_rows
+
+    def replace_table(
+        self, target_name: str, source_name: str, streamed: bool = False
+    ) -> None:
+        """コピージョブ（WRITE_TRUNCATE）でtarget_nameのデータをsource_nameで置き換え、完了まで待つ
+        DELETE / INSERTと違いアトミックで、クエリの料金もかかりません
+        （target_nameがない場合は作成されます）
+        streamed: source_nameにストリーミング挿入した場合
+            ストリーミングバッファの行はコピージョブで読めないため、
+            CREATE OR REPLACE TABLE ... AS SELECT（こちらもアトミック）で置き換えます
+        """
+        if streamed:
+            self.execute_query_wait(
+                f"CREATE OR REPLACE TABLE `{target_name}` AS SELECT * FROM `{source_name}`"
+            )
+            return
+        job_config: bigquery.CopyJobConfig = bigquery.CopyJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        job: bigquery.CopyJob = self.cli.copy_table(
+            source_name, target_name, job_config=job_config
+        )
+        job.result()
+
     def execute_query_wait(self, query: str) -> RowIterator:
         return self.cli.query_and_wait(query)
@@ -1,7 +1,7 @@
 import json
-import boto3
 from typing import Dict
 from global_settings import GlobalSettings
+from .aws_clients import get_client
 
 
 class Ssm:
@@ -9,7 +9,7 @@ class Ssm:
     credentials: Dict
 
     def __init__(self, settings: GlobalSettings, credentials: Dict = {}) -> None:
-        self.ssm = boto3.client("ssm", region_name=settings.AWS_REGION)
+        self.ssm = get_client("ssm", settings.AWS_REGION)
         self.credentials: Dict = credentials
         self.settings: GlobalSettings = settings
 
@@ -1,22 +1,37 @@
-import json
-from typing import Dict
+from typing import BinaryIO, Dict, Iterator, Optional
 from global_settings import GlobalSettings
 from lib import bq_manager
 
-from .utils import register_to_bigquery_table
+from .utils import (
+    non_empty_records,
+    register_parquet_to_bigquery_table,
+    register_to_bigquery_table,
+)
 
 
-def doRegist(data: bytes, settings=GlobalSettings()) -> bool:
+def doRegist(
+    body: Optional[BinaryIO], settings=GlobalSettings(), file_format: str = "json"
+) -> bool:
+    """
+    body: クローラーの出力ファイルのストリーム（展開済み）。先頭から順に一度だけ読みます
+    """
     BIGQUERY_TABLE: str = "printpac_seal_prices"
 
-    converted_data: Dict = {} if data == None else json.loads(data.decode("utf-8"))
-    if len(converted_data) == 0:
+    if body == None:
         return False
+    records: Optional[Iterator[Dict]] = None
+    if file_format != "parquet":
+        records = non_empty_records(body, file_format)
+        if records is None:
+            return False
 
     pricing_query: bq_manager.PricingQuery = bq_manager.PricingQuery(settings)
     bq_full_name: str = pricing_query.get_qualified_fullname(BIGQUERY_TABLE)
 
-    register_to_bigquery_table(pricing_query, bq_full_name, converted_data)
+    if file_format == "parquet":
+        register_parquet_to_bigquery_table(pricing_query, bq_full_name, body)
+    else:
+        register_to_bigquery_table(pricing_query, bq_full_name, records)
     print(f"[{BIGQUERY_TABLE.split('.')[-1]}] registration completed")
 
     return True
@@ -1,146 +1,129 @@
-from time import sleep
-from typing import Dict, List
+from itertools import chain, islice
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional
 from datetime import datetime
-from google.cloud.bigquery.table import RowIterator
+
+import ijson
 from lib import bq_manager
 from google.cloud import bigquery
 
 from registers.bigquery_schema import TABLE_SCHEMA
 
+# 1回のロードジョブで読み込むレコード数（/tmpの一時ファイルの大きさの上限になる）
+LOAD_JOB_ROWS: int = 500 * 1000
 
-def _delete_old_data(pricing_query: bq_manager.PricingQuery, table: str) -> None:
-    try:
-        pricing_query.execute_query_wait(f"DELETE FROM `{table}` where 1=1")
-        print(f"Deleted old data in table [{table.split('.')[-1]}]")
-    except Exception as e:
-        print(f"Failed to delete old data in table[{table.split('.')[-1]}]")
-        print(e)
-        raise e
 
+def iter_records(body: BinaryIO, file_format: str = "json") -> Iterator[Dict]:
+    """
+    クローラーの出力ファイルをストリームから読みながら、レコード（PriceSchema）を1件ずつ返す
+    json:   {"1": {...}, "2": {...}}
+    ndjson: 1行に1レコード
+    ファイル全体をメモリに読み込まないため、ファイルの大きさに関係なく使えます
+    """
+    # 数値はDecimalではなくint/floatにする（insert_rows_jsonでJSONにするため）
+    if file_format == "ndjson":
+        return ijson.items(body, "", multiple_values=True, use_float=True)
+    return (record for _, record in ijson.kvitems(body, "", use_float=True))
 
-def _drop_temp_table(pricing_query: bq_manager.PricingQuery, temp_table: str) -> None:
-    try:
-        pricing_query.get_table(temp_table)
-        pricing_query.drop_table(temp_table)
-        print(f"Temporary table [{temp_table.split('.')[-1]}] deleted")
-    except:
-        print(f"Temporary table [{temp_table.split('.')[-1]}] doesn't exist. Skip.")
 
+def non_empty_records(
+    body: BinaryIO, file_format: str = "json"
+) -> Optional[Iterator[Dict]]:
+    """
+    iter_recordsと同じ。ただし、レコードが1件もない場合はNone
+    """
+    records: Iterator[Dict] = iter_records(body, file_format)
+    for first in records:
+        return chain((first,), records)
+    return None
 
-def _create_main_table(pricing_query: bq_manager.PricingQuery, main_table: str) -> None:
-    try:
-        pricing_query.get_table(main_table)
-        return
-    except:
-        print(f"Main table [{main_table.split('.')[-1]}] doesn't exist")
 
+def _drop_temp_table(pricing_query: bq_manager.PricingQuery, temp_table: str) -> None:
     try:
-        pricing_query.create_table(main_table, TABLE_SCHEMA)
-        print(f"Created table [{main_table.split('.')[-1]}]")
+        pricing_query.drop_table(temp_table, not_found_ok=True)
+        print(f"Temporary table [{temp_table.split('.')[-1]}] deleted")
     except Exception as e:
-        print(f"Cannot create main table [{main_table}] - ", e)
+        # 元の例外を隠さないように、削除に失敗してもログだけ残す
+        print(f"Failed to delete temporary table [{temp_table.split('.')[-1]}]: {e}")
 
 
-def _create_temp_table(
-    pricing_query: bq_manager.PricingQuery, main_table: str, temp_table: str
-) -> None:
-    try:
-        pricing_query.get_table(temp_table)
-        return
-    except:
-        print(f"Temporary table [{temp_table.split('.')[-1]}] doesn't exist")
-
-    try:
-        # Get the schema from the source table
-        source_table: bigquery.Table = pricing_query.get_table(main_table)
-        schema: List[bigquery.SchemaField] = source_table.schema
-
-        # Create the temporary table with the same schema
-        pricing_query.create_table(temp_table, schema)
-        print(f"Created table [{temp_table.split('.')[-1]}]")
-        sleep(3)
-
-    except Exception as e:
-        print("Failed to create temporary table: ", temp_table)
-        print(e)
-        raise e
+def _stream_new_data_to_temp_table(
+    pricing_query: bq_manager.PricingQuery, temp_table: str, records: Iterable[Dict]
+) -> int:
+    # GlobalSettings.BQ_STREAMING_INSERTの場合（ストリーミング挿入のバッチを並行して送る）
+    pricing_query.create_table(temp_table, TABLE_SCHEMA)
+    loaded: int = pricing_query.persist_from_jsonlist_concurrently(temp_table, records)
+    print(
+        f"Loaded [{loaded}] records to temporary table [{temp_table.split('.')[-1]}] "
+    )
+    return loaded
 
 
 def _load_new_data_to_temp_table(
-    pricing_query: bq_manager.PricingQuery, temp_table: str, data: Dict
-) -> None:
-    table_exists = False
-    while not table_exists:
-        try:
-            pricing_query.get_table(temp_table)
-            table_exists = True
-            print(f"Table [{temp_table.split('.')[-1]}] is now available.")
-        except:
-            print(f"Table {temp_table} not found. Waiting...")
-            sleep(1)
-
-    batch_size = 30 * 1000
-    records: List = []
-    for idx in data:
-        records.append(data[idx])
-
-    batches: List = [
-        records[i : i + batch_size] for i in range(0, len(records), batch_size)
-    ]
-
-    for batch in batches:
-        pricing_query.persist_from_jsonlist(temp_table, batch)
-        sleep(1)
+    pricing_query: bq_manager.PricingQuery, temp_table: str, records: Iterable[Dict]
+) -> int:
+    # LOAD_JOB_ROWS件ずつロードジョブで読み込む（レコードは一時ファイルに書き出すだけでメモリに溜めない）
+    # 最初のジョブでテンポラリテーブルを作成する（既にある場合は置き換える）
+    iterator: Iterator[Dict] = iter(records)
+    write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE
+    loaded: int = 0
+    while True:
+        count: int = pricing_query.load_from_jsonlist(
+            temp_table,
+            islice(iterator, LOAD_JOB_ROWS),
+            write_disposition,
+            TABLE_SCHEMA,
+        )
+        if count == 0:
+            return loaded
+        write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+        loaded += count
         print(
-            f"Loaded [{len(batch)}] records to temporary table [{temp_table.split('.')[-1]}] "
+            f"Loaded [{count}] records to temporary table [{temp_table.split('.')[-1]}] "
         )
 
 
-def _verify_data(pricing_query: bq_manager.PricingQuery, table, data_len: int) -> None:
-    query: str = f"SELECT COUNT(*) as row_count FROM `{table}`"
-    result: RowIterator = pricing_query.execute_query_wait(query)
-    row_count: int = 0
-    for row in result:
-        row_count: int = row.row_count
-
-    if row_count != data_len:
-        raise ValueError("Row count verification failed")
-
-    print(f"Row count verification OK on table [{table.split('.')[-1]}]")
-
-
-def _copy_data_to_main_table(
+def register_to_bigquery_table(
     pricing_query: bq_manager.PricingQuery,
     bq_full_name: str,
-    temp_table: str,
-) -> None:
-    try:
-        query: str = f"""
-        INSERT INTO `{bq_full_name}`
-        SELECT * FROM `{temp_table}`
-        """
-        pricing_query.execute_query_wait(query)
-        print(f"Copied data to [{bq_full_name.split('.')[-1]}].")
-    except Exception as e:
-        raise RuntimeError(f"Failed to copy data to the main table: {e}")
-
-
-def register_to_bigquery_table(
-    pricing_query: bq_manager.PricingQuery, bq_full_name: str, data: Dict
+    records: Iterable[Dict],
 ) -> None:
+    """
+    records: レコードのイテレータ（一度だけ読み、LOAD_JOB_ROWS件ずつロードジョブで読み込む）
+    テンポラリテーブルにすべて読み込んでから、コピージョブでメインテーブルをアトミックに置き換える
+    （件数の確認はロードジョブごとに行い、途中で失敗した場合はメインテーブルは変更されない）
+    """
     unique_suffix: str = datetime.now().strftime("%Y%m%d%H%M%S")
     temp_table: str = bq_full_name + "_temp_" + unique_suffix
 
+    streamed: bool = pricing_query.settings.BQ_STREAMING_INSERT
     try:
-        _create_main_table(pricing_query, bq_full_name)
-        _create_temp_table(pricing_query, bq_full_name, temp_table)
-        _load_new_data_to_temp_table(pricing_query, temp_table, data)
-        _verify_data(pricing_query, temp_table, len(data))
-        _delete_old_data(pricing_query, bq_full_name)
-        _copy_data_to_main_table(pricing_query, bq_full_name, temp_table)
-        _drop_temp_table(pricing_query, temp_table)
-        _verify_data(pricing_query, bq_full_name, len(data))
-    except Exception as e:
-        # テンポラリテーブルの蓄積を防ぐため、何か問題が発生した場合はテンポラリテーブルを削除する。
+        if streamed:
+            data_len: int = _stream_new_data_to_temp_table(
+                pricing_query, temp_table, records
+            )
+        else:
+            data_len = _load_new_data_to_temp_table(pricing_query, temp_table, records)
+        pricing_query.replace_table(bq_full_name, temp_table, streamed)
+        print(f"Replaced [{bq_full_name.split('.')[-1]}] with [{data_len}] records")
+    finally:
+        # テンポラリテーブルの蓄積を防ぐため、成功・失敗にかかわらずテンポラリテーブルを削除する。
         _drop_temp_table(pricing_query, temp_table)
-        raise e
+
+
+def register_parquet_to_bigquery_table(
+    pricing_query: bq_manager.PricingQuery, bq_full_name: str, body: BinaryIO
+) -> None:
+    """
+    Parquetは1つのロードジョブ（WRITE_TRUNCATE）でメインテーブルを直接置き換える
+    （列の型を持っているため、レコードに展開せずS3のストリームをそのままアップロードする）
+    JSONの場合と同じくTABLE_SCHEMAを指定し、ファイルの列がスキーマに合わない場合はジョブを失敗させる
+    ジョブが失敗した場合、メインテーブルは変更されない
+    """
+    loaded: int = pricing_query.load_from_file(
+        bq_full_name,
+        body,
+        bigquery.SourceFormat.PARQUET,
+        bigquery.WriteDisposition.WRITE_TRUNCATE,
+        TABLE_SCHEMA,
+    )
+    print(f"Replaced [{bq_full_name.split('.')[-1]}] with [{loaded}] records")